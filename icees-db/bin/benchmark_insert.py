@@ -0,0 +1,53 @@
+"""Benchmark table loading methods.
+
+The table is dropped and recreated before every run, so point this at a
+scratch database, not a deployed one.
+"""
+import argparse
+import sys
+from time import perf_counter
+
+from icees_db.db import DBConnection
+from icees_db.dbutils import CHUNK_SIZE, db_, insert, read_headers
+from icees_db.model import generate_metadata
+
+
+def benchmark(file_path, table_name, methods, chunk_size=CHUNK_SIZE, repeat=3):
+    """Load `file_path` with each method and report the best time."""
+    metadata = generate_metadata({table_name: read_headers(file_path, table_name)})
+    table = metadata.tables[table_name]
+    results = {}
+    for method in methods:
+        timings = []
+        for _ in range(repeat):
+            with DBConnection() as conn:
+                with conn.begin():
+                    table.drop(conn, checkfirst=True)
+                    table.create(conn)
+            start = perf_counter()
+            nrows = insert(file_path, table_name, chunk_size=chunk_size, method=method)
+            timings.append(perf_counter() - start)
+        best = min(timings)
+        results[method] = (nrows, best)
+        print(f"{method}: {nrows} rows in {best:.3f}s ({nrows / best:.0f} rows/sec)")
+    if "insert" in results and len(results) > 1:
+        base = results["insert"][1]
+        for method, (_, elapsed) in results.items():
+            if method != "insert":
+                print(f"{method}: {base / elapsed:.2f}x speedup over insert")
+    with DBConnection() as conn:
+        with conn.begin():
+            table.drop(conn, checkfirst=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='ICEES DB insert benchmark')
+    parser.add_argument('input_file', type=str, help='csv file')
+    parser.add_argument('table_name', type=str, help='table name')
+    parser.add_argument('--method', type=str, action='append', choices=['insert', 'copy'], help='load method to benchmark (repeatable)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='number of rows inserted and committed per batch')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per method')
+    args = parser.parse_args(sys.argv[1:])
+    methods = args.method or (["insert", "copy"] if db_ == "postgres" else ["insert"])
+    benchmark(args.input_file, args.table_name, methods, args.chunk_size, args.repeat)
@@ -1,44 +1,291 @@
 """Initialize database."""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
 import logging
 import os
 import tempfile
 from pathlib import Path
+from time import perf_counter
 
-from icees_db.dbutils import create, insert, create_indices, read_headers
-from icees_db.features import features_dict
+from sqlalchemy import inspect
+
+from icees_db.advisor import read_query_log
+from icees_db.binedges import update_bins
+from icees_db.binning import get_binner
+from icees_db.bitmap import build as build_bitmap_index
+from icees_db.cache import invalidate, precompute
+from icees_db.cohort import invalidate as invalidate_cohorts
+from icees_db.db import DBConnection, sqlite_bulk_load
+from icees_db.dbutils import (
+    create, drop, insert, create_indices, read_index_profile, db_,
+    add_missing_columns, analyze, delete_years, BIN_FEATURES,
+)
+from icees_db.features import get_features_dict
+from icees_db.manifest import plan, read_manifest, shard_info, write_manifest
 from icees_db.model import generate_metadata
+from icees_db.partition import PARTITION_BY_YEAR, create_partitions
+from icees_db.schema import discover_schema
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+
+def load_workers():
+    """Number of shards loaded concurrently.
+
+    Bounded by LOAD_WORKERS (default: cpu count) and, on postgres, by the
+    connection pool size. SQLite allows a single writer, so it loads serially.
+    """
+    if db_ == "sqlite":
+        return 1
+    workers = int(os.environ.get("LOAD_WORKERS", os.cpu_count() or 1))
+    pool_size = int(os.environ.get("POOL_SIZE", 10)) + int(os.environ.get("MAX_OVERFLOW", 0))
+    return max(1, min(workers, pool_size))
+
+
+def shards(csvdir):
+    """List (table, file path) for every CSV shard under `csvdir`/<table>/."""
+    result = []
+    for t in os.listdir(csvdir):
+        if t in get_features_dict():
+            table_dir = csvdir + "/" + t
+            if os.path.isdir(table_dir):
+                logger.info(table_dir + " exists")
+                for f in sorted(os.listdir(table_dir)):
+                    result.append((t, table_dir + "/" + f))
+    return result
+
+
+def bins_plan(table_shards, staging_dir=None):
+    """CSV shards and years whose `_qcut` edges an incremental load recomputes.
+
+    Shards are compared to the manifest as `load_incremental` sees them, as
+    their Parquet file if it is staged and up to date. Returns the CSV
+    shards to sketch and the affected years of each table, or all shards and
+    None if nothing was loaded yet.
+    """
+    with DBConnection() as conn:
+        if not inspect(conn).has_table("manifest"):
+            return table_shards, None
+        manifest = read_manifest(conn, generate_metadata({}))
+    sources = {}
+    for t, csv_path in table_shards:
+        path = csv_path
+        if staging_dir:
+            from icees_db.staging import is_staged, staged_path  # requires pyarrow
+            parquet_path = staged_path(staging_dir, t, csv_path)
+            if is_staged(t, parquet_path, csv_path):
+                path = str(parquet_path)
+        sources[path] = (t, csv_path)
+    to_load, affected, _ = plan(manifest, [(t, path) for path, (t, _) in sources.items()])
+    return [sources[path] for _, path, _ in to_load], affected
+
+
+def shard_infos(table_shards):
+    """Manifest entries (without row counts) of (table, file path) shards.
+
+    Checksums and years are read in a process pool of LOAD_WORKERS workers
+    (default: cpu count); reading is not limited by the database.
+    """
+    workers = int(os.environ.get("LOAD_WORKERS", os.cpu_count() or 1))
+    tables = [t for t, _ in table_shards]
+    paths = [path for _, path in table_shards]
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(shard_info, tables, paths))
+
+
+def load_shard(table, file_path, info=None):
+    """Load one shard.
+
+    Returns its manifest entry (computed here unless `info` is given, with
+    the row count filled in) and the elapsed load time.
+    """
+    start = perf_counter()
+    nrows = insert(file_path, table)
+    elapsed = perf_counter() - start
+    info = dict(info) if info is not None else shard_info(table, file_path)
+    info["rows"] = nrows
+    return info, elapsed
+
+
+def drop_tables(metadata):
+    drop(metadata)
+
+
+def load(metadata, table_shards, workers=None, on_failure=drop_tables):
+    """Load (table, file path[, manifest entry]) shards concurrently.
+
+    If any shard fails, the remaining shards are cancelled and `on_failure`
+    is called with the metadata (by default dropping the tables), so a failed
+    load never leaves a partially populated database. Returns the manifest
+    entries of the loaded shards.
+    """
+    workers = workers or load_workers()
+    logger.info(f"loading {len(table_shards)} shards with {workers} workers")
+    totals = {}
+    infos = []
+    start = perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(load_shard, *shard): shard
+            for shard in table_shards
+        }
+        try:
+            for future in as_completed(futures):
+                t, file_path = futures[future][:2]
+                info, elapsed = future.result()
+                nrows = info["rows"]
+                logger.info(f"loaded {file_path}: {nrows} rows in {elapsed:.1f}s")
+                rows, seconds = totals.get(t, (0, 0))
+                totals[t] = (rows + nrows, seconds + elapsed)
+                infos.append(info)
+        except BaseException:
+            logger.error(f"failed to load {file_path}")
+            executor.shutdown(wait=True, cancel_futures=True)
+            on_failure(metadata)
+            raise
+    for t, (rows, seconds) in totals.items():
+        logger.info(f"{t}: {rows} rows, {seconds:.1f}s total load time")
+    logger.info(f"loaded all shards in {perf_counter() - start:.1f}s")
+    return infos
+
+
+def load_incremental(metadata, table_shards):
+    """Load only new or changed shards, replacing the rows of affected years.
+
+    Returns the affected years of each table.
+    """
+    add_missing_columns(metadata)
+    with DBConnection() as conn:
+        manifest = read_manifest(conn, metadata)
+    to_load, affected, removed = plan(manifest, table_shards)
+    if not affected:
+        logger.info("no new or changed shards")
+        return {}
+    logger.info(
+        "replacing " + ", ".join(f"{t} {sorted(years)}" for t, years in affected.items())
+        + f" from {len(to_load)} shards"
+    )
+
+    def forget(metadata):
+        # leave the affected years empty and unrecorded, so the next
+        # incremental load retries all of them
+        delete_years(metadata, affected)
+        with DBConnection() as conn:
+            with conn.begin():
+                write_manifest(conn, metadata, [], [path for _, path, _ in to_load])
+
+    delete_years(metadata, affected)
+    infos = load(metadata, to_load, on_failure=forget)
+    with DBConnection() as conn:
+        with conn.begin():
+            write_manifest(conn, metadata, infos, removed)
+    return affected
+
+
+@contextmanager
+def phase(timings, name):
+    """Record the duration of a setup phase in `timings`."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = perf_counter() - start
+        logger.info(f"{name} took {timings[name]:.1f}s")
+
+
 def setup():
-    table_columns = {}
+    """Build the database, returning the duration of each phase.
+
+    On sqlite the bulk load profile (see `icees_db.db.sqlite_bulk_load`) is
+    used for the whole build unless SQLITE_BULK_LOAD=0.
+    """
+    timings = {}
+    bulk = os.environ.get("SQLITE_BULK_LOAD", "1") == "1"
+    with sqlite_bulk_load() if bulk else nullcontext():
+        _setup(timings)
+    logger.info("phase timings: " + ", ".join(
+        f"{name} {seconds:.1f}s" for name, seconds in timings.items()
+    ))
+    return timings
+
+
+def _setup(timings):
     csvdir = os.environ.get("DATA_PATH", "db/data/")
-    for t in os.listdir(csvdir):
-      if t in features_dict:
-          table_dir = csvdir + "/" + t
-          if os.path.isdir(table_dir):
-              logger.info(table_dir + " exists")
-              for f in os.listdir(table_dir):
-                  table = table_dir + "/" + f
-                  logger.info("loading headers of " + table)
-                  table_columns[t] = read_headers(table, t)
-                  break
-
-    metadata = generate_metadata(table_columns)
-
-    create(metadata)
-    for t in os.listdir(csvdir):
-      if t in features_dict:
-        table_dir = csvdir + "/" + t
-        if os.path.isdir(table_dir):
-            logger.info(table_dir + " exists")
-            for f in os.listdir(table_dir):
-                table = table_dir + "/" + f
-                logger.info("loading " + table)
-                insert(table, t)
-
-    create_indices(metadata)
+    table_shards = shards(csvdir)
+    staging_dir = os.environ.get("STAGING_PATH")
+    incremental = os.environ.get("LOAD_MODE", "full") == "incremental"
+    if BIN_FEATURES and os.environ.get("RECOMPUTE_BINS", "0") == "1":
+        with phase(timings, "bins"):
+            if incremental:
+                # loaded years keep the edges their rows were binned with
+                bin_shards, years = bins_plan(table_shards, staging_dir)
+            else:
+                bin_shards, years = table_shards, None
+            if bin_shards:
+                update_bins(bin_shards, years=years)
+                get_binner.cache_clear()
+    if staging_dir:
+        from icees_db.staging import stage  # requires pyarrow
+        with phase(timings, "stage"):
+            table_shards = stage(table_shards, staging_dir)
+    with phase(timings, "schema"):
+        schema = discover_schema(table_shards)
+        metadata = generate_metadata(schema.table_columns, PARTITION_BY_YEAR)
+        create(metadata)
+
+    with phase(timings, "load"):
+        if incremental:
+            affected = load_incremental(metadata, table_shards)
+            if not affected:
+                return
+            tables = list(affected)
+            years = sorted(set().union(*affected.values()))
+            with DBConnection() as conn:
+                with conn.begin():
+                    invalidate_cohorts(conn, metadata, years)
+        else:
+            if PARTITION_BY_YEAR:
+                # the years of every shard, to create their partitions first
+                table_shards = [
+                    (t, path, info)
+                    for (t, path), info in zip(table_shards, shard_infos(table_shards))
+                ]
+                table_years = {}
+                for t, _, info in table_shards:
+                    table_years.setdefault(t, set()).update(info["years"])
+                with DBConnection() as conn:
+                    with conn.begin():
+                        create_partitions(conn, metadata, table_years)
+            infos = load(metadata, table_shards)
+            with DBConnection() as conn:
+                with conn.begin():
+                    write_manifest(conn, metadata, infos)
+            tables = list(schema.table_columns)
+            years = None
+
+    with phase(timings, "index"):
+        index_profile = os.environ.get("INDEX_PROFILE")
+        create_indices(
+            metadata,
+            composite_features=read_index_profile(index_profile) if index_profile else None,
+        )
+    with phase(timings, "analyze"):
+        analyze(tables)
+
+    if os.environ.get("PRECOMPUTE_CACHE", "1") == "1":
+        with phase(timings, "cache"):
+            if years is not None:
+                with DBConnection() as conn:
+                    with conn.begin():
+                        invalidate(conn, metadata, years)
+            query_log = os.environ.get("CACHE_QUERY_LOG")
+            precompute(metadata, list(read_query_log(query_log)) if query_log else [], years)
+
+    bitmap_path = os.environ.get("BITMAP_INDEX_PATH")
+    if bitmap_path:
+        with phase(timings, "bitmap"):
+            build_bitmap_index().save(bitmap_path)
 
 
 if __name__ == "__main__":
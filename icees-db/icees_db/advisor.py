@@ -0,0 +1,192 @@
+"""Workload-driven index advisor.
+
+Building a (year, feature, feature2) index for every pair of features is
+unaffordable, so this ranks the feature pairs that actually show up in a log
+of feature association queries and builds composite indexes only for the
+most frequent ones that fit in a disk budget.
+"""
+import argparse
+from collections import Counter
+from dataclasses import dataclass
+import json
+import logging
+import sys
+from typing import Dict, List, Tuple
+
+from sqlalchemy import Index, MetaData, func, select
+
+from .db import DBConnection
+from .dbutils import existing_indices, index_name
+from .partition import partition_table, partitions, reflect
+from .features import get_feature_index
+
+logger = logging.getLogger(__name__)
+
+# approximate btree entry overhead (tuple header, item pointer, alignment)
+ENTRY_OVERHEAD = 16
+FILL_FACTOR = 0.9
+STRING_WIDTH = 16
+
+
+@dataclass
+class Recommendation:
+    table: str
+    feature_a: str
+    feature_b: str
+    frequency: int
+    size: int
+    benefit: float
+
+    @property
+    def name(self):
+        """Index name, truncated to postgres' 63 characters."""
+        return index_name(f"pair_{self.table}_{self.feature_a}_{self.feature_b}")
+
+
+def read_query_log(file_path) -> Counter:
+    """Count (table, feature_a, feature_b) pairs in a query log.
+
+    The log is either a JSON array or one JSON object per line, each shaped
+    like examples/feature_association.json with an optional "table" key
+    (default "patient"). Pairs are unordered.
+    """
+    with open(file_path, "r") as stream:
+        content = stream.read().strip()
+    if content.startswith("["):
+        queries = json.loads(content)
+    else:
+        queries = [json.loads(line) for line in content.splitlines() if line.strip()]
+    pairs = Counter()
+    for query in queries:
+        table = query.get("table", "patient")
+        for feature_a in query["feature_a"]:
+            for feature_b in query["feature_b"]:
+                if feature_a != feature_b:
+                    a, b = sorted((feature_a, feature_b))
+                    pairs[(table, a, b)] += 1
+    return pairs
+
+
+def _cardinality(table, feature_name):
+    feature = get_feature_index()[table].get(feature_name)
+    return len(feature.options) if feature and feature.options else None
+
+
+def _width(table, feature_name):
+    feature = get_feature_index()[table].get(feature_name)
+    if feature is None:
+        return STRING_WIDTH
+    if feature._type is str:
+        if feature.options:
+            return max(len(str(option)) for option in feature.options) + 1
+        return STRING_WIDTH
+    return 8 if feature._type is float else 4
+
+
+def recommend(
+        pairs: Counter,
+        table_stats: Dict[str, Tuple[int, int]],
+        top_n=10,
+        budget=None,
+) -> List[Recommendation]:
+    """Pick the most frequent pairs that fit in `budget` bytes.
+
+    `table_stats` maps each table to its (row count, number of years).
+    The estimated benefit of an index is the number of rows a query no longer
+    visits compared to using the single column index on the more selective
+    feature, times the query frequency.
+    """
+    recommendations = []
+    used = 0
+    for (table, a, b), frequency in pairs.most_common():
+        if len(recommendations) >= top_n:
+            break
+        if table not in table_stats:
+            continue
+        rows, years = table_stats[table]
+        size = int(rows * (ENTRY_OVERHEAD + 4 + _width(table, a) + _width(table, b)) / FILL_FACTOR)
+        if budget is not None and used + size > budget:
+            continue
+        # features without options are assumed to be as selective as possible
+        # in a single column index, i.e. no benefit beyond it
+        na = _cardinality(table, a) or rows
+        nb = _cardinality(table, b) or rows
+        single = rows / max(na, nb)
+        composite = rows / (max(years, 1) * na * nb)
+        benefit = frequency * max(single - composite, 0)
+        used += size
+        recommendations.append(Recommendation(table, a, b, frequency, size, benefit))
+    return recommendations
+
+
+def table_statistics(conn, tables):
+    """Row count and number of distinct years of each table."""
+    return {
+        name: tuple(conn.execute(select(
+            func.count(),
+            func.count(table.c.year.distinct()),
+        ).select_from(table)).one())
+        for name, table in tables.items()
+    }
+
+
+def advise(log_path, top_n=10, budget=None, dry_run=False):
+    """Recommend and build composite indexes for a query log."""
+    pairs = read_query_log(log_path)
+    table_names = {table for table, _, _ in pairs}
+    metadata = MetaData()
+    with DBConnection() as conn:
+        reflect(conn, metadata, only=list(table_names))
+        stats = table_statistics(conn, metadata.tables)
+        existing = existing_indices(conn, table_names)
+    recommendations = recommend(pairs, stats, top_n, budget)
+    for rec in recommendations:
+        status = "exists" if rec.name in existing else "new"
+        logger.info(
+            f"{rec.table} ({rec.feature_a}, {rec.feature_b}): "
+            f"{rec.frequency} queries, ~{rec.size / 2**20:.1f} MB, "
+            f"~{rec.benefit:.0f} rows saved ({status})"
+        )
+    if not dry_run:
+        with DBConnection() as conn:
+            with conn.begin():
+                for rec in recommendations:
+                    if rec.name in existing:
+                        continue
+                    table = metadata.tables[rec.table]
+                    year_tables = partitions(conn, rec.table) if conn.dialect.name == "sqlite" else {}
+                    if year_tables:
+                        # a view of per-year tables, indexed one year at a time
+                        year_existing = existing_indices(conn, year_tables.values())
+                        for year in sorted(year_tables):
+                            name = f"{rec.name}_{year}"
+                            if name in year_existing:
+                                continue
+                            partition = partition_table(table, year)
+                            logger.info("creating index " + name)
+                            Index(
+                                name,
+                                partition.c[rec.feature_a],
+                                partition.c[rec.feature_b],
+                            ).create(conn)
+                        continue
+                    logger.info("creating index " + rec.name)
+                    Index(
+                        rec.name,
+                        table.c.year,
+                        table.c[rec.feature_a],
+                        table.c[rec.feature_b],
+                    ).create(conn)
+    return recommendations
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='ICEES DB index advisor')
+    parser.add_argument('query_log', type=str, help='feature association query log (JSON array or JSON lines)')
+    parser.add_argument('--top', type=int, default=10, help='maximum number of indexes')
+    parser.add_argument('--budget-mb', type=float, default=None, help='disk budget for new indexes in MB')
+    parser.add_argument('--dry-run', action='store_true', help='only report recommendations')
+    args = parser.parse_args(sys.argv[1:])
+    budget = int(args.budget_mb * 2**20) if args.budget_mb is not None else None
+    advise(args.query_log, args.top, budget, args.dry_run)
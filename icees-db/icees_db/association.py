@@ -0,0 +1,168 @@
+"""Association of one feature to all other features, in one pass.
+
+For a request like examples/associations_to_all_features.json, the rows of
+the contingency tables are the constraints on the requested feature (a
+single constraint splits the cohort into the rows that satisfy it and the
+rows that do not) and the columns are the values of each other feature.
+All tables are counted from the column store with one `np.bincount` per
+block of features, over codes offset so that every (feature, value, row)
+has its own bin, and they are scored together with `icees_db.stats`.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+from .bitmap import select_values
+from .canonical import canonical_features
+from .stats import bonferroni, chi_square, fisher_exact, odds_ratio
+
+logger = logging.getLogger(__name__)
+
+# features with more values (e.g. continuous ones) are not tested
+MAX_CATEGORIES = int(os.environ.get("ASSOCIATION_MAX_CATEGORIES", 256))
+BLOCK_SIZE = int(os.environ.get("ASSOCIATION_BLOCK_SIZE", 256))
+# bound on features x cohort rows per block, to bound the int64 bin array
+BLOCK_ELEMENTS = int(os.environ.get("ASSOCIATION_BLOCK_ELEMENTS", 1 << 24))
+
+
+def row_index(values, codes, constraints):
+    """Contingency table row of each row of the store, -1 if in none.
+
+    A list of constraints gives one row per constraint (the first one a
+    value satisfies); a single constraint gives the rows that satisfy it
+    and those that do not. Missing values are in no row.
+    """
+    if isinstance(constraints, list):
+        selected = [select_values(values, c) for c in constraints]
+    else:
+        selected = [select_values(values, constraints)]
+        selected.append(~selected[0])
+    lookup = np.full(len(values) + 1, -1, dtype=np.int64)
+    for i, mask in reversed(list(enumerate(selected))):
+        lookup[:-1][mask] = i
+    return lookup[codes]
+
+
+def contingency_tables(store, table, year, cohort_mask, rows, nrows, features):
+    """Counts of (row, value) of each feature, within the cohort.
+
+    Returns one (nrows, number of values) array per feature. Blocks hold
+    at most BLOCK_SIZE features and BLOCK_ELEMENTS codes, and codes keep
+    their width until they are turned into bins in one int64 array.
+    """
+    in_table = cohort_mask & (rows >= 0)
+    rows = rows[in_table]
+    block_size = max(1, min(BLOCK_SIZE, BLOCK_ELEMENTS // max(len(rows), 1)))
+    tables = []
+    for start in range(0, len(features), block_size):
+        block = features[start:start + block_size]
+        columns = [store.column(table, year, name) for name in block]
+        # a bin per (feature, value or missing, row)
+        sizes = np.array([len(values) + 1 for values, _ in columns])
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        bins = np.stack([codes[in_table] for _, codes in columns]).astype(np.int64)
+        bins += offsets[:, None]
+        bins *= nrows
+        bins += rows[None, :]
+        counts = np.bincount(bins.ravel(), minlength=sizes.sum() * nrows)
+        counts = counts.reshape(-1, nrows).T
+        for offset, size in zip(offsets, sizes):
+            tables.append(counts[:, offset:offset + size - 1])
+    return tables
+
+
+def associations_to_all_features(
+        store,
+        table,
+        year,
+        cohort_features,
+        feature,
+        maximum_p_value=1,
+        correction=None,
+):
+    """Associations of `feature` ({name: constraint(s)}) to every other feature.
+
+    `correction` is None or {"method": "bonferroni"}. Returns one result per
+    tested feature whose (corrected) p-value is at most `maximum_p_value`,
+    ordered by p-value.
+    """
+    cohort_features = canonical_features(table, cohort_features)
+    (name, constraints), = canonical_features(table, feature).items()
+    cohort_mask = store.mask(table, year, cohort_features)
+    values, codes = store.column(table, year, name)
+    rows = row_index(values, codes, constraints)
+    nrows = len(constraints) if isinstance(constraints, list) else 2
+
+    features = [
+        other
+        for other, (other_values, _) in store.columns[(table, year)].items()
+        if other != name and len(other_values) <= MAX_CATEGORIES
+    ]
+    tables = contingency_tables(store, table, year, cohort_mask, rows, nrows, features)
+    width = max((t.shape[1] for t in tables), default=0)
+    stacked = np.zeros((len(tables), nrows, width), dtype=np.int64)
+    for i, t in enumerate(tables):
+        stacked[i, :, :t.shape[1]] = t
+    statistic, dof, p_value = chi_square(stacked)
+
+    # odds ratios and exact tests of the 2x2 tables
+    two_by_two = np.array([t.shape == (2, 2) for t in tables], dtype=bool)
+    ratio = np.full(len(tables), np.nan)
+    fisher_p_value = np.full(len(tables), np.nan)
+    if two_by_two.any():
+        ratio[two_by_two] = odds_ratio(stacked[two_by_two, :, :2])[0]
+        fisher_p_value[two_by_two] = fisher_exact(stacked[two_by_two, :, :2])
+
+    if correction is not None and correction.get("method") == "bonferroni":
+        corrected = bonferroni(p_value)
+    elif correction is None:
+        corrected = p_value
+    else:
+        raise ValueError(f"Unsupported correction '{correction.get('method')}'")
+
+    results = []
+    for i in np.argsort(corrected, kind="stable"):
+        if not corrected[i] <= maximum_p_value:
+            continue
+        other_values = store.column(table, year, features[i])[0]
+        results.append({
+            "feature_a": {name: constraints},
+            "feature_b": features[i],
+            "columns": other_values.tolist(),
+            "counts": tables[i].tolist(),
+            "chi_squared": float(statistic[i]),
+            "dof": int(dof[i]),
+            "p_value": float(p_value[i]),
+            "p_value_corrected": float(corrected[i]),
+        })
+        if two_by_two[i]:
+            results[-1]["odds_ratio"] = float(ratio[i])
+            results[-1]["fisher_exact_p_value"] = float(fisher_p_value[i])
+    return results
+
+
+if __name__ == "__main__":
+    from .columnar import build
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='ICEES DB associations to all features')
+    parser.add_argument('request', type=str, help='request JSON, like examples/associations_to_all_features.json')
+    parser.add_argument('--table', type=str, default='patient', help='table name')
+    parser.add_argument('--year', type=int, required=True, help='year')
+    args = parser.parse_args(sys.argv[1:])
+    with open(args.request, "r") as stream:
+        request = json.load(stream)
+    results = associations_to_all_features(
+        build([args.table]),
+        args.table,
+        args.year,
+        request.get("cohort_features", {}),
+        request["feature"],
+        request.get("maximum_p_value", 1),
+        request.get("correction"),
+    )
+    print(json.dumps(results, indent=4))
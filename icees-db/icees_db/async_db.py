@@ -0,0 +1,102 @@
+"""Asyncio database tools.
+
+The async counterpart of `icees_db.db`, on an async SQLAlchemy engine
+(asyncpg for postgres, aiosqlite for sqlite), so queries can be fanned out
+concurrently, e.g. per year and per table.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+import os
+from pathlib import Path
+from time import perf_counter
+
+from sqlalchemy import column, func, select, table
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+
+from .db import _register_pool_events, db, metrics, pool_capacity, pool_options
+
+async_engine = None
+
+
+def get_async_db_connection():
+    """Get async database engine, configured like `get_db_connection`."""
+    global async_engine
+    if async_engine is None:
+        if db == "sqlite":
+            DB_PATH = Path(os.environ["DB_PATH"])
+            async_engine = create_async_engine(
+                f"sqlite+aiosqlite:///{DB_PATH / 'example.db'}",
+                **pool_options(),
+            )
+        elif db == "postgres":
+            serv_host = os.environ["ICEES_HOST"]
+            serv_port = os.environ["ICEES_PORT"]
+            async_engine = create_async_engine(
+                f"postgresql+asyncpg://icees_dbuser:icees_dbpass@{serv_host}:{serv_port}/icees_database",
+                **pool_options(),
+            )
+        else:
+            raise ValueError(f"Unsupported database '{db}'")
+        _register_pool_events(async_engine.sync_engine)
+
+    return async_engine
+
+
+@asynccontextmanager
+async def AsyncDBConnection() -> AsyncConnection:
+    """Async database connection, retried like `DBConnection`."""
+    engine = get_async_db_connection()
+    sleep_sec = 0.5
+    while True:
+        start = perf_counter()
+        try:
+            conn: AsyncConnection = await engine.connect()
+            metrics.record_wait(perf_counter() - start)
+            break
+        except OperationalError as err:
+            metrics.add("connection_errors")
+            sleep_sec *= 2
+            if sleep_sec > 16:
+                raise err
+            print(
+                "Failed to connect to the database. "
+                f"Retrying in {sleep_sec} seconds..."
+            )
+            await asyncio.sleep(sleep_sec)
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+
+async def count_values(table_name, feature, year):
+    """Value counts of a feature in one year: {value: count}."""
+    t = table(table_name, column("year"), column(feature))
+    async with AsyncDBConnection() as conn:
+        result = await conn.execute(
+            select(t.c[feature], func.count())
+            .where(t.c.year == year)
+            .group_by(t.c[feature])
+        )
+        return dict(result.all())
+
+
+async def feature_counts(requests, concurrency=None):
+    """Run `count_values` for (table, feature, year) requests concurrently.
+
+    Each request uses its own pooled connection. At most `concurrency`
+    (default: the pool capacity) run at once, so the others wait here rather
+    than time out waiting for a connection. Returns the counts in the order
+    of `requests`.
+    """
+    semaphore = asyncio.Semaphore(concurrency or pool_capacity())
+
+    async def limited(table_name, feature, year):
+        async with semaphore:
+            return await count_values(table_name, feature, year)
+
+    return await asyncio.gather(*(
+        limited(table_name, feature, year)
+        for table_name, feature, year in requests
+    ))
@@ -0,0 +1,218 @@
+"""Recomputation of the quantile bin edges in config/bins.json.
+
+The edges of the `_qcut` features are the minimum, the 1/n, ..., (n-1)/n
+quantiles and the maximum of the raw values of each year. Rather than
+sorting whole exposure columns, the CSV shards are streamed in chunks into
+one KLL quantile sketch per (year, table, feature), so memory stays bounded
+and the quantiles are approximate with a rank error of about 1/k.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from .config import get_config_path
+from .dbutils import CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+SKETCH_SIZE = int(os.environ.get("SKETCH_SIZE", 200))
+
+
+class QuantileSketch:
+    """KLL sketch of a stream of numbers.
+
+    Level h holds items of weight 2**h. A level over its capacity is sorted
+    and every other item, from a random offset, moves up a level. The
+    minimum and maximum are kept exactly.
+    """
+
+    def __init__(self, k=SKETCH_SIZE, seed=0):
+        self.k = k
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, h):
+        depth = len(self.levels) - 1 - h
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, values):
+        """Add an array of values, ignoring NaN."""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.n += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                level = np.sort(self.levels[h])
+                odd = len(level) % 2
+                self.levels[h] = level[:odd]
+                promoted = level[odd + self._rng.integers(2)::2]
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+            h += 1
+
+    def quantiles(self, qs):
+        """Approximate quantiles; 0 and 1 are the exact minimum and maximum."""
+        qs = np.asarray(qs, dtype=np.float64)
+        if self.n == 0:
+            return np.full(len(qs), np.nan)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([
+            np.full(len(level), 2 ** h, dtype=np.int64)
+            for h, level in enumerate(self.levels)
+        ])
+        order = np.argsort(items, kind="stable")
+        items = items[order]
+        cumulative = np.cumsum(weights[order])
+        i = np.searchsorted(cumulative, qs * cumulative[-1], side="left")
+        result = items[np.minimum(i, len(items) - 1)]
+        result[qs <= 0] = self.min
+        result[qs >= 1] = self.max
+        return result
+
+
+def qcut_features(bins):
+    """Number of bins of each (table, `_qcut` feature), from its latest edges."""
+    nbins = {}
+    for year in sorted(bins, key=int):
+        for table, features in bins[year].items():
+            for feature, edges in features.items():
+                if feature.endswith("_qcut") and edges is not None:
+                    nbins[(table, feature)] = len(edges) - 1
+    return nbins
+
+
+def sketch_shards(table_shards, nbins, chunk_size=CHUNK_SIZE, years=None):
+    """Stream raw values of the binned features of CSV shards into sketches.
+
+    Only the years in `years` (a mapping of table to years) are sketched if
+    it is given. Returns sketches by (year, table, feature).
+    """
+    sketches = {}
+    for table, file_path in table_shards:
+        with open(file_path, "r", newline="") as stream:
+            header = next(csv.reader(stream), [])
+        columns = [col for col in header if (table, col) in nbins]
+        if not columns:
+            continue
+        for df in pd.read_csv(
+                file_path,
+                usecols=["year"] + columns,
+                dtype=str,
+                chunksize=chunk_size,
+        ):
+            row_years = pd.to_numeric(df["year"], errors="coerce").to_numpy()
+            chunk_years = [
+                int(year) for year in np.unique(row_years[~np.isnan(row_years)])
+                if years is None or int(year) in years.get(table, ())
+            ]
+            for col in columns:
+                values = pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=np.float64)
+                for year in chunk_years:
+                    key = (year, table, col)
+                    if key not in sketches:
+                        sketches[key] = QuantileSketch()
+                    sketches[key].update(values[row_years == year])
+    return sketches
+
+
+def drift(old, new):
+    """Largest shift of an edge, relative to the old range; None if incomparable."""
+    if old is None or len(old) != len(new):
+        return None
+    old = np.asarray(old, dtype=np.float64)
+    span = old[-1] - old[0]
+    if span <= 0:
+        return None
+    return float(np.max(np.abs(np.asarray(new) - old)) / span)
+
+
+def recompute(table_shards, bins, chunk_size=CHUNK_SIZE, years=None):
+    """Recompute the `_qcut` edges of every year in the shards.
+
+    With `years` (a mapping of table to years), only those years are
+    recomputed and the edges of other years are kept. Returns the updated
+    bins (a copy) and the drift of each recomputed (year, table, feature)
+    versus its previous edges.
+    """
+    nbins = qcut_features(bins)
+    sketches = sketch_shards(table_shards, nbins, chunk_size, years)
+    updated = json.loads(json.dumps(bins))
+    report = {}
+    for (year, table, feature), sketch in sorted(sketches.items()):
+        if sketch.n == 0:
+            continue
+        n = nbins[(table, feature)]
+        edges = sketch.quantiles(np.arange(n + 1) / n).tolist()
+        features = updated.setdefault(str(year), {}).setdefault(table, {})
+        report[(year, table, feature)] = drift(features.get(feature), edges)
+        features[feature] = edges
+    for (year, table, feature), shift in report.items():
+        if shift is None:
+            logger.info(f"{year} {table}.{feature}: new edges")
+        else:
+            logger.info(f"{year} {table}.{feature}: edges moved by {shift:.1%} of the range")
+    return updated, report
+
+
+def write_bins(bins, file_path):
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as stream:
+        json.dump(bins, stream, indent=4)
+    os.replace(tmp_path, file_path)
+
+
+def bins_path():
+    return os.path.join(get_config_path(), "bins.json")
+
+
+def update_bins(table_shards, file_path=None, chunk_size=CHUNK_SIZE, years=None):
+    """Recompute the `_qcut` edges of the shards' years in bins.json in place.
+
+    `years` is as for `recompute`.
+    """
+    file_path = file_path or bins_path()
+    with open(file_path, "r") as stream:
+        bins = json.load(stream)
+    updated, report = recompute(table_shards, bins, chunk_size, years)
+    write_bins(updated, file_path)
+    return report
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='ICEES DB bin edges')
+    parser.add_argument('data_path', type=str, help='directory of <table>/ CSV shards with raw values')
+    parser.add_argument('--bins', type=str, default=None, help='bins.json to read (default: the config directory)')
+    parser.add_argument('--output', type=str, default=None, help='bins.json to write (default: overwrite --bins)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='number of rows read per batch')
+    args = parser.parse_args(sys.argv[1:])
+    table_shards = [
+        (table, os.path.join(args.data_path, table, name))
+        for table in sorted(os.listdir(args.data_path))
+        if os.path.isdir(os.path.join(args.data_path, table))
+        for name in sorted(os.listdir(os.path.join(args.data_path, table)))
+        if name.endswith(".csv")
+    ]
+    with open(args.bins or bins_path(), "r") as stream:
+        bins = json.load(stream)
+    updated, _ = recompute(table_shards, bins, args.chunk_size)
+    write_bins(updated, args.output or args.bins or bins_path())
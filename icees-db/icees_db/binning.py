@@ -0,0 +1,125 @@
+"""Binning of continuous features with the edges in config/bins.json.
+
+bins.json maps year -> table -> feature -> bin edges (or null). Bins are
+closed on the left, [a, b), to match labelled ranges such as "3-17" for
+edges 3 and 18. The quantile bins of the `_qcut` features are closed on the
+right and the first one also includes the lowest edge, like `pandas.qcut`.
+Values outside the edges are missing. Bin i is labelled with the i-th
+option of the feature in the catalogue, e.g. "0-2" for AgeStudyStart, or
+1..5 for the `_qcut` features.
+"""
+from functools import lru_cache
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .config import get_config_path
+from .features import get_feature_index
+
+
+def closed_right(feature):
+    """Whether the bins of a feature are closed on the right (quantile bins)."""
+    return feature.endswith("_qcut")
+
+
+class Binner:
+    """Bin edges of every (year, table, feature) as NumPy arrays."""
+
+    def __init__(self, bins):
+        self.edges = {
+            (int(year), table, feature): np.asarray(edges, dtype=np.float64)
+            for year, tables in bins.items()
+            for table, features in tables.items()
+            for feature, edges in features.items()
+            if edges is not None
+        }
+        self._features = {}
+        for _, table, feature in self.edges:
+            self._features.setdefault(table, set()).add(feature)
+
+    @classmethod
+    def from_file(cls, file_path):
+        with open(file_path, "r") as stream:
+            return cls(json.load(stream))
+
+    def features(self, table):
+        """Features of a table with bin edges in some year."""
+        return self._features.get(table, set())
+
+    def digest(self, table, years):
+        """sha256 of the edges of a table's features in the given years."""
+        edges = sorted(
+            (year, feature, edges.tolist())
+            for (year, t, feature), edges in self.edges.items()
+            if t == table and year in years
+        )
+        return hashlib.sha256(json.dumps(edges).encode()).hexdigest()
+
+    def labels(self, table, year, feature):
+        """Labels of the bins of a feature: its options, or 1, 2, ..."""
+        nbins = len(self.edges[(year, table, feature)]) - 1
+        feature = get_feature_index()[table].get(feature)
+        if feature is not None and feature.options is not None and len(feature.options) == nbins:
+            return np.array(list(feature.options))
+        return np.arange(1, nbins + 1)
+
+    def codes(self, table, year, feature, values):
+        """Bin index of each value, -1 where missing or out of range.
+
+        Every value is missing if the feature has no edges for the year.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        edges = self.edges.get((year, table, feature))
+        if edges is None:
+            return np.full(len(values), -1, dtype=np.int64)
+        if closed_right(feature):
+            codes = np.digitize(values, edges, right=True) - 1
+            codes[values == edges[0]] = 0
+        else:
+            codes = np.digitize(values, edges) - 1
+        codes[(codes < 0) | (codes >= len(edges) - 1) | np.isnan(values)] = -1
+        return codes
+
+    def bin_frame(self, df, table, report=None):
+        """Replace the raw values of binned feature columns by bin labels.
+
+        `df` holds CSV strings with a "year" column; binned columns get the
+        labels as strings ("" where missing), ready for `coerce_columns`.
+        Raw values that cannot be binned (not numbers, out of range, or in a
+        year without edges) are counted in `report` (column -> Counter of
+        rejected values) if it is given.
+        """
+        columns = [col for col in df.columns if col in self.features(table)]
+        if not columns:
+            return df
+        df = df.copy()
+        years = pd.to_numeric(df["year"], errors="coerce").to_numpy()
+        for col in columns:
+            # as dbutils._to_float: to_numeric only finds the valid values, as
+            # it does not parse every float exactly and edges are exact
+            valid = pd.to_numeric(df[col], errors="coerce").notna()
+            values = df[col].where(valid, None).astype(float).to_numpy(dtype=np.float64)
+            binned = np.full(len(df), "", dtype=object)
+            for year in np.unique(years[~np.isnan(years)]):
+                year = int(year)
+                if (year, table, col) not in self.edges:
+                    continue
+                rows = years == year
+                labels = np.append(self.labels(table, year, col).astype(str), "")
+                binned[rows] = labels[self.codes(table, year, col, values[rows])]
+            if report is not None:
+                raw = df[col].to_numpy(dtype=object)
+                rejected = (binned == "") & (raw != "") & pd.notna(raw)
+                if rejected.any():
+                    report[col].update(raw[rejected].tolist())
+            df[col] = binned
+        return df
+
+
+@lru_cache(maxsize=None)
+def get_binner():
+    """Binner of config/bins.json, read on first use."""
+    return Binner.from_file(os.path.join(get_config_path(), "bins.json"))
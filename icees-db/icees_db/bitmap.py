@@ -0,0 +1,200 @@
+"""Bitmap index of feature values.
+
+For every (table, year) the rows are ordered by id, and every feature with
+few distinct values gets one bitmap per value marking the rows that have it.
+A cohort, a conjunction of feature constraints like those of
+examples/feature_association.json, is then the AND of the bitmaps of its
+constraints, and cohort sizes and value counts are popcounts.
+
+Bitmaps are NumPy bit arrays (`np.packbits`), stored one matrix per feature
+with a row per value. The index is persisted with `np.savez_compressed`.
+"""
+import argparse
+from functools import lru_cache
+import logging
+import operator
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from .dbutils import read_table_years
+from .features import get_feature_index
+
+logger = logging.getLogger(__name__)
+
+# features with more distinct values (e.g. continuous exposures) get no bitmaps
+MAX_VALUES = int(os.environ.get("BITMAP_MAX_VALUES", 64))
+
+OPERATORS = {
+    "=": operator.eq,
+    "<>": operator.ne,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+}
+
+
+def select_values(values, constraint):
+    """Boolean mask of the `values` that satisfy a feature constraint.
+
+    A constraint is {"operator": op, "value": v} for the comparison
+    operators, {"operator": "in", "values": [...]}, or
+    {"operator": "between", "value_a": a, "value_b": b}.
+    """
+    op = constraint["operator"]
+    if op in OPERATORS:
+        return OPERATORS[op](values, constraint["value"])
+    if op == "in":
+        return np.isin(values, constraint["values"])
+    if op == "between":
+        return (values >= constraint["value_a"]) & (values <= constraint["value_b"])
+    raise ValueError(f"Unsupported operator '{op}'")
+
+
+def popcount(bits):
+    """Number of set bits along the last axis."""
+    return np.bitwise_count(bits).sum(axis=-1, dtype=np.int64)
+
+
+class BitmapIndex:
+    """Value bitmaps of every (table, year).
+
+    `ids[(table, year)]` holds the row ids in bitmap order and
+    `bitmaps[(table, year)][feature]` a (values, bits) pair where `bits`
+    has one packed bitmap row per value.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.bitmaps = {}
+
+    def add(self, table, year, df):
+        """Index the rows of one table and year (a data frame ordered by id)."""
+        id_col = table[0].upper() + table[1:] + "Id"
+        catalogue = get_feature_index()[table]
+        self.ids[(table, year)] = df[id_col].to_numpy(dtype=np.int64)
+        bitmaps = self.bitmaps[(table, year)] = {}
+        for name in df.columns:
+            if name in (id_col, "year"):
+                continue
+            codes, uniques = pd.factorize(df[name], sort=True)
+            if len(uniques) > MAX_VALUES:
+                continue
+            feature = catalogue.get(name)
+            values = uniques.to_numpy()
+            if feature is not None and feature._type is int:
+                values = values.astype(np.int64)
+            elif feature is not None and feature._type is str:
+                values = values.astype(str)
+            one_hot = codes[None, :] == np.arange(len(values))[:, None]
+            bitmaps[name] = (values, np.packbits(one_hot, axis=1))
+
+    def nrows(self, table, year):
+        return len(self.ids[(table, year)])
+
+    def feature(self, table, year, feature):
+        """(values, bits) of a feature."""
+        try:
+            return self.bitmaps[(table, year)][feature]
+        except KeyError:
+            raise ValueError(f"No bitmaps of {table}.{feature} in {year}") from None
+
+    def cohort(self, table, year, cohort_features):
+        """Bitmap of the rows that satisfy every constraint of `cohort_features`.
+
+        Constraint values are cast to the feature types first (see
+        `icees_db.canonical`), so 1 matches the option "1" as it does in SQL.
+        """
+        from .canonical import canonical_features  # imports this module
+
+        nrows = self.nrows(table, year)
+        bits = np.packbits(np.ones(nrows, dtype=bool))
+        for feature, constraint in canonical_features(table, cohort_features).items():
+            values, feature_bits = self.feature(table, year, feature)
+            mask = select_values(values, constraint)
+            bits &= np.bitwise_or.reduce(feature_bits[mask], axis=0) if mask.any() else 0
+        return bits
+
+    def members(self, table, year, bits):
+        """Row ids of a cohort bitmap."""
+        mask = np.unpackbits(bits, count=self.nrows(table, year)).astype(bool)
+        return self.ids[(table, year)][mask]
+
+    def count(self, table, year, cohort_features):
+        """Size of a cohort."""
+        return int(popcount(self.cohort(table, year, cohort_features)))
+
+    def value_counts(self, table, year, cohort_features, feature):
+        """Counts of each value of `feature` within a cohort: {value: count}."""
+        values, bits = self.feature(table, year, feature)
+        counts = popcount(bits & self.cohort(table, year, cohort_features))
+        return dict(zip(values.tolist(), counts.tolist()))
+
+    def contingency(self, table, year, cohort_features, feature_a, feature_b):
+        """Contingency table of two features within a cohort.
+
+        Returns the values of `feature_a`, the values of `feature_b` and the
+        matrix of counts.
+        """
+        cohort = self.cohort(table, year, cohort_features)
+        values_a, bits_a = self.feature(table, year, feature_a)
+        values_b, bits_b = self.feature(table, year, feature_b)
+        counts = popcount((bits_a & cohort)[:, None, :] & bits_b[None, :, :])
+        return values_a, values_b, counts
+
+    def save(self, path):
+        """Write the index to a compressed .npz file."""
+        arrays = {}
+        for (table, year), ids in self.ids.items():
+            arrays[f"{table}/{year}/ids"] = ids
+            for feature, (values, bits) in self.bitmaps[(table, year)].items():
+                arrays[f"{table}/{year}/{feature}/values"] = values
+                arrays[f"{table}/{year}/{feature}/bits"] = bits
+        with open(path, "wb") as stream:
+            np.savez_compressed(stream, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Read an index written by `save`."""
+        index = cls()
+        with np.load(path) as arrays:
+            for key in arrays.files:
+                table, year, *rest = key.split("/")
+                year = int(year)
+                if rest == ["ids"]:
+                    index.ids[(table, year)] = arrays[key]
+                elif rest[1] == "values":
+                    feature = rest[0]
+                    bits = arrays[f"{table}/{year}/{feature}/bits"]
+                    index.bitmaps.setdefault((table, year), {})[feature] = (arrays[key], bits)
+        return index
+
+
+def build(tables=None):
+    """Build the bitmap index of the feature tables from the database."""
+    index = BitmapIndex()
+    for table, year, df in read_table_years(tables):
+        index.add(table, year, df)
+        logger.info(
+            f"indexed {len(df)} {table} rows of {year}, "
+            f"{len(index.bitmaps[(table, year)])} features"
+        )
+    return index
+
+
+@lru_cache(maxsize=None)
+def get_bitmap_index():
+    """The index at BITMAP_INDEX_PATH, loaded on first use."""
+    return BitmapIndex.load(os.environ["BITMAP_INDEX_PATH"])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='ICEES DB bitmap index')
+    parser.add_argument('output', type=str, help='.npz file to write')
+    parser.add_argument('--table', type=str, action='append', help='only index these tables (repeatable)')
+    args = parser.parse_args(sys.argv[1:])
+    build(args.table).save(args.output)
@@ -0,0 +1,423 @@
+"""Precomputed count and contingency table cache.
+
+Entries live in the `cache` (feature pair contingency tables) and
+`cache_count` (feature value counts) tables and are keyed by a digest of
+(table, year, cohort features, feature_a, feature_b). Lookups refresh
+`access_time` when the database is writable, in their own transaction (the
+`ResultCache` batches them), and `evict` drops the least recently used
+entries.
+"""
+import argparse
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from functools import lru_cache
+import json
+import logging
+import os
+import sys
+from threading import Lock
+import time
+
+from sqlalchemy import MetaData, delete, func, insert, select, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from .advisor import read_query_log
+from .canonical import canonical_feature, canonical_features, encode as _encode, request_digest
+from .db import SQLITE_READONLY, DBConnection
+from .dbutils import non_feature_tables
+from .partition import reflect
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 1024))
+# seconds between checks of the manifest for a newer load
+RESULT_CACHE_CHECK_INTERVAL = float(os.environ.get("RESULT_CACHE_CHECK_INTERVAL", 10))
+# seconds between batched refreshes of the access time of result cache hits
+RESULT_CACHE_TOUCH_INTERVAL = float(os.environ.get("RESULT_CACHE_TOUCH_INTERVAL", 10))
+# digests per access time update
+TOUCH_BATCH = 500
+
+
+def digest(table, year, cohort_features, feature_a, feature_b=None) -> bytes:
+    """Cache key of a count (no `feature_b`) or a contingency table.
+
+    Features are names or constraint mappings; the key is computed on their
+    canonical form (see `icees_db.canonical`), so equivalent requests share it.
+    """
+    return request_digest(
+        table,
+        year,
+        canonical_features(table, cohort_features),
+        canonical_feature(table, feature_a),
+        canonical_feature(table, feature_b),
+    )
+
+
+def _feature_column(table, feature):
+    """Value of the feature_a/feature_b columns: a name or a canonical mapping."""
+    if feature is None or isinstance(feature, str):
+        return feature
+    return _encode(canonical_feature(table, feature))
+
+
+def _year_filter(table, years):
+    return [table.c.year.in_(years)] if years is not None else []
+
+
+def precompute_counts(conn, metadata, table_name, years=None):
+    """Cache per-year value counts of every feature of a table.
+
+    Counts are stored as [[value, count], ...].
+    """
+    table = metadata.tables[table_name]
+    cache_count = metadata.tables["cache_count"]
+    id_col = table_name[0].upper() + table_name[1:] + "Id"
+    conn.execute(delete(cache_count).where(
+        cache_count.c.table == table_name,
+        cache_count.c.cohort_features == _encode({}),
+        *([cache_count.c.cohort_year.in_(years)] if years is not None else []),
+    ))
+    now = datetime.utcnow()
+    nentries = 0
+    for column in table.c:
+        if column.name in (id_col, "year"):
+            continue
+        counts = defaultdict(list)
+        for year, value, count in conn.execute(
+            select(table.c.year, column, func.count())
+            .where(*_year_filter(table, years))
+            .group_by(table.c.year, column)
+        ):
+            counts[year].append([value, count])
+        rows = [
+            {
+                "digest": digest(table_name, year, {}, column.name),
+                "table": table_name,
+                "cohort_features": _encode({}),
+                "cohort_year": year,
+                "feature_a": column.name,
+                "count": _encode(value_counts),
+                "access_time": now,
+            }
+            for year, value_counts in counts.items()
+        ]
+        if rows:
+            conn.execute(insert(cache_count), rows)
+            nentries += len(rows)
+    logger.info(f"cached {nentries} {table_name} counts")
+    return nentries
+
+
+def precompute_associations(conn, metadata, pairs, years=None):
+    """Cache per-year contingency tables of (table, feature_a, feature_b) pairs.
+
+    Contingency tables are stored as [[value_a, value_b, count], ...].
+    """
+    cache = metadata.tables["cache"]
+    now = datetime.utcnow()
+    nentries = 0
+    for table_name, feature_a, feature_b in pairs:
+        table = metadata.tables[table_name]
+        keys = {}
+        contingency = defaultdict(list)
+        for year, value_a, value_b, count in conn.execute(
+            select(table.c.year, table.c[feature_a], table.c[feature_b], func.count())
+            .where(*_year_filter(table, years))
+            .group_by(table.c.year, table.c[feature_a], table.c[feature_b])
+        ):
+            contingency[year].append([value_a, value_b, count])
+        for year in contingency:
+            keys[year] = digest(table_name, year, {}, feature_a, feature_b)
+        if not keys:
+            continue
+        conn.execute(delete(cache).where(cache.c.digest.in_(list(keys.values()))))
+        conn.execute(insert(cache), [
+            {
+                "digest": keys[year],
+                "table": table_name,
+                "cohort_features": _encode({}),
+                "cohort_year": year,
+                "feature_a": feature_a,
+                "feature_b": feature_b,
+                "association": _encode(value_counts),
+                "access_time": now,
+            }
+            for year, value_counts in contingency.items()
+        ])
+        nentries += len(keys)
+    logger.info(f"cached {nentries} contingency tables")
+    return nentries
+
+
+def _lookup(conn, metadata, cache_table, value_column, key, refresh):
+    row = conn.execute(
+        select(value_column).where(cache_table.c.digest == key).limit(1)
+    ).first()
+    if row is None:
+        return None
+    if refresh:
+        touch(metadata, {cache_table.name: [key]})
+    return json.loads(row[0])
+
+
+def touch(metadata, keys):
+    """Refresh the access time of cache entries, best effort.
+
+    `keys` maps a cache table name to digests. The update runs in its own
+    short transaction on its own connection, so it is committed whatever
+    the caller's connection does. Skipped on a read-only database; a failed
+    update (e.g. a locked database) is logged.
+    """
+    if SQLITE_READONLY or not any(keys.values()):
+        return
+    now = datetime.utcnow()
+    try:
+        with DBConnection() as conn:
+            with conn.begin():
+                for name, digests in keys.items():
+                    cache_table = metadata.tables[name]
+                    digests = list(digests)
+                    for start in range(0, len(digests), TOUCH_BATCH):
+                        conn.execute(
+                            update(cache_table)
+                            .where(cache_table.c.digest.in_(digests[start:start + TOUCH_BATCH]))
+                            .values(access_time=now)
+                        )
+    except SQLAlchemyError as err:
+        logger.warning(f"could not refresh cache access time: {err}")
+
+
+def lookup_count(conn, metadata, table, year, cohort_features, feature, refresh=True):
+    """Cached value counts, or None on a miss.
+
+    With `refresh`, a hit refreshes the entry's access time (see `touch`).
+    """
+    cache_count = metadata.tables["cache_count"]
+    key = digest(table, year, cohort_features, feature)
+    return _lookup(conn, metadata, cache_count, cache_count.c.count, key, refresh)
+
+
+def lookup_association(conn, metadata, table, year, cohort_features, feature_a, feature_b, refresh=True):
+    """Cached contingency table, or None on a miss.
+
+    With `refresh`, a hit refreshes the entry's access time (see `touch`).
+    """
+    cache = metadata.tables["cache"]
+    key = digest(table, year, cohort_features, feature_a, feature_b)
+    return _lookup(conn, metadata, cache, cache.c.association, key, refresh)
+
+
+def store_count(conn, metadata, table, year, cohort_features, feature, count):
+    """Add value counts computed for a request to the cache."""
+    cache_count = metadata.tables["cache_count"]
+    key = digest(table, year, cohort_features, feature)
+    conn.execute(delete(cache_count).where(cache_count.c.digest == key))
+    conn.execute(insert(cache_count).values(
+        digest=key,
+        table=table,
+        cohort_features=_encode(canonical_features(table, cohort_features)),
+        cohort_year=year,
+        feature_a=_feature_column(table, feature),
+        count=_encode(count),
+        access_time=datetime.utcnow(),
+    ))
+
+
+def store_association(conn, metadata, table, year, cohort_features, feature_a, feature_b, association):
+    """Add a contingency table computed for a request to the cache."""
+    cache = metadata.tables["cache"]
+    key = digest(table, year, cohort_features, feature_a, feature_b)
+    conn.execute(delete(cache).where(cache.c.digest == key))
+    conn.execute(insert(cache).values(
+        digest=key,
+        table=table,
+        cohort_features=_encode(canonical_features(table, cohort_features)),
+        cohort_year=year,
+        feature_a=_feature_column(table, feature_a),
+        feature_b=_feature_column(table, feature_b),
+        association=_encode(association),
+        access_time=datetime.utcnow(),
+    ))
+
+
+def invalidate(conn, metadata, years):
+    """Drop every cache entry of the given years, e.g. after they are reloaded."""
+    get_result_cache().clear()
+    ninvalidated = 0
+    for name in ("cache", "cache_count"):
+        cache_table = metadata.tables[name]
+        ninvalidated += conn.execute(
+            delete(cache_table).where(cache_table.c.cohort_year.in_(years))
+        ).rowcount
+    logger.info(f"invalidated {ninvalidated} cache entries of {years}")
+    return ninvalidated
+
+
+def evict(conn, metadata, max_entries):
+    """Keep only the `max_entries` most recently used entries of each cache table."""
+    nevicted = 0
+    for name in ("cache", "cache_count"):
+        cache_table = metadata.tables[name]
+        stale = (
+            select(cache_table.c.digest)
+            .order_by(cache_table.c.access_time.desc())
+            .offset(max_entries)
+        )
+        nevicted += conn.execute(
+            delete(cache_table).where(cache_table.c.digest.in_(stale))
+        ).rowcount
+    logger.info(f"evicted {nevicted} cache entries")
+    return nevicted
+
+
+class ResultCache:
+    """Two-tier cache of counts and contingency tables computed for requests.
+
+    The first tier is an in-process LRU of `maxsize` entries, the second the
+    `cache` and `cache_count` tables. Both are keyed by `digest`, so
+    equivalent requests hit the same entry. The LRU is emptied by
+    `invalidate`, and when the manifest records a newer load, which is
+    checked at most every `check_interval` seconds; the tables are
+    invalidated by the loader. Hits in either tier are collected and their
+    access times refreshed together with `touch` at most every
+    `touch_interval` seconds, or by `flush`.
+    """
+
+    def __init__(
+            self,
+            maxsize=RESULT_CACHE_SIZE,
+            check_interval=RESULT_CACHE_CHECK_INTERVAL,
+            touch_interval=RESULT_CACHE_TOUCH_INTERVAL,
+    ):
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self.touch_interval = touch_interval
+        self._checked = None
+        self._entries = OrderedDict()
+        self._touched = defaultdict(set)
+        self._flushed = time.monotonic()
+        self._lock = Lock()
+        self._version = None
+        self.memory_hits = 0
+        self.database_hits = 0
+        self.misses = 0
+
+    def _check_version(self, conn, metadata):
+        now = time.monotonic()
+        with self._lock:
+            if self._checked is not None and now - self._checked < self.check_interval:
+                return
+            self._checked = now
+        manifest = metadata.tables["manifest"]
+        version = conn.execute(select(func.max(manifest.c.load_time))).scalar()
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def flush(self, metadata):
+        """Refresh the access time of the hits collected since the last flush."""
+        with self._lock:
+            keys, self._touched = self._touched, defaultdict(set)
+            self._flushed = time.monotonic()
+        touch(metadata, keys)
+
+    def _hit(self, metadata, name, key):
+        with self._lock:
+            self._touched[name].add(key)
+            due = time.monotonic() - self._flushed >= self.touch_interval
+        if due:
+            self.flush(metadata)
+
+    def get(self, conn, metadata, table, year, cohort_features, feature_a, feature_b=None):
+        """Cached value counts (no `feature_b`) or contingency table, or None."""
+        self._check_version(conn, metadata)
+        key = digest(table, year, cohort_features, feature_a, feature_b)
+        name = "cache_count" if feature_b is None else "cache"
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+        if result is not None:
+            self._hit(metadata, name, key)
+            return result
+        if feature_b is None:
+            result = lookup_count(conn, metadata, table, year, cohort_features, feature_a, refresh=False)
+        else:
+            result = lookup_association(
+                conn, metadata, table, year, cohort_features, feature_a, feature_b, refresh=False,
+            )
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.database_hits += 1
+        self._remember(key, result)
+        self._hit(metadata, name, key)
+        return result
+
+    def put(self, conn, metadata, result, table, year, cohort_features, feature_a, feature_b=None):
+        """Add a computed result to both tiers."""
+        if feature_b is None:
+            store_count(conn, metadata, table, year, cohort_features, feature_a, result)
+        else:
+            store_association(conn, metadata, table, year, cohort_features, feature_a, feature_b, result)
+        self._remember(digest(table, year, cohort_features, feature_a, feature_b), result)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._checked = None
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "database_hits": self.database_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+
+
+@lru_cache(maxsize=None)
+def get_result_cache():
+    """The result cache of this process."""
+    return ResultCache()
+
+
+def precompute(metadata, pairs=(), years=None, max_entries=None):
+    """Fill the cache after a load.
+
+    Caches counts of every feature table, contingency tables of `pairs`, and
+    evicts down to `max_entries` entries per cache table if given.
+    """
+    with DBConnection() as conn:
+        with conn.begin():
+            for table_name in metadata.tables:
+                if table_name not in non_feature_tables:
+                    precompute_counts(conn, metadata, table_name, years)
+            precompute_associations(conn, metadata, pairs, years)
+            if max_entries is not None:
+                evict(conn, metadata, max_entries)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='ICEES DB cache')
+    parser.add_argument('--query-log', type=str, default=None, help='feature association query log whose pairs are precomputed')
+    parser.add_argument('--year', type=int, action='append', help='only recompute these years (repeatable)')
+    parser.add_argument('--max-entries', type=int, default=None, help='evict down to this many entries per cache table')
+    args = parser.parse_args(sys.argv[1:])
+    metadata = MetaData()
+    with DBConnection() as conn:
+        reflect(conn, metadata)
+    pairs = list(read_query_log(args.query_log)) if args.query_log else []
+    precompute(metadata, pairs, args.year, args.max_entries)
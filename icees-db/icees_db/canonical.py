@@ -0,0 +1,111 @@
+"""Canonical form of feature constraints and request digests.
+
+Equivalent requests are written in many ways: keys in another order,
+"==" for "=", "1" for 1, `>= 4` for `in [4, 5]` on a feature with options
+1..5. The canonical form makes them equal, so they share one digest:
+
+- constraints on a feature are keyed by name in sorted order;
+- operator aliases are replaced ("==" by "=", "!=" by "<>");
+- values are cast to the feature's type from the catalogue;
+- on features with options (enums, integer ranges and the bins of
+  config/bins.json), every constraint becomes the set of options it
+  selects, written as "=" for one option and as a sorted "in" otherwise.
+"""
+import hashlib
+import json
+
+import numpy as np
+
+from .bitmap import select_values
+from .features import get_feature_index
+
+OPERATOR_ALIASES = {
+    "==": "=",
+    "!=": "<>",
+    "IN": "in",
+    "BETWEEN": "between",
+}
+
+def _to_int(value):
+    """An integer, or a float that is not one, so it still compares exactly."""
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+_casts = {
+    int: _to_int,
+    float: float,
+    str: str,
+}
+
+
+def _cast(feature, value):
+    if feature is None or value is None:
+        return value
+    try:
+        return _casts[feature._type](value)
+    except (TypeError, ValueError):
+        return value
+
+
+def canonical_constraint(table, name, constraint):
+    """Canonical form of one constraint on feature `name` of `table`."""
+    feature = get_feature_index()[table].get(name)
+    op = OPERATOR_ALIASES.get(constraint["operator"], constraint["operator"])
+    if op == "in":
+        constraint = {"operator": op, "values": [_cast(feature, v) for v in constraint["values"]]}
+    elif op == "between":
+        constraint = {
+            "operator": op,
+            "value_a": _cast(feature, constraint["value_a"]),
+            "value_b": _cast(feature, constraint["value_b"]),
+        }
+    else:
+        constraint = {"operator": op, "value": _cast(feature, constraint["value"])}
+
+    if feature is not None and feature.options is not None:
+        options = np.array(list(feature.options))
+        try:
+            selected = sorted(options[select_values(options, constraint)].tolist())
+        except TypeError:
+            # a value of another type than the options, e.g. a number on an enum
+            return constraint
+    elif op == "in":
+        selected = sorted(set(constraint["values"]), key=repr)
+    else:
+        return constraint
+    if len(selected) == 1:
+        return {"operator": "=", "value": selected[0]}
+    return {"operator": "in", "values": selected}
+
+
+def canonical_features(table, features):
+    """Canonical form of {feature: constraint or [constraint, ...]}.
+
+    Lists of constraints (one per row or column of a contingency table) keep
+    their order.
+    """
+    return {
+        name: (
+            [canonical_constraint(table, name, c) for c in constraint]
+            if isinstance(constraint, list)
+            else canonical_constraint(table, name, constraint)
+        )
+        for name, constraint in sorted(features.items())
+    }
+
+
+def canonical_feature(table, feature):
+    """A feature name as is, or the canonical form of a constraint mapping."""
+    if feature is None or isinstance(feature, str):
+        return feature
+    return canonical_features(table, feature)
+
+
+def encode(obj):
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"))
+
+
+def request_digest(*parts) -> bytes:
+    """sha256 of the JSON encoding of already canonical parts."""
+    return hashlib.sha256(encode(list(parts)).encode()).digest()
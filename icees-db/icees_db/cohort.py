@@ -0,0 +1,159 @@
+"""Materialised cohorts.
+
+A cohort is the set of rows of a table and year that satisfy a conjunction
+of feature constraints. Its members, the sorted row ids, are stored in the
+`cohort` table next to its definition, so a cohort is evaluated once and
+reused by later count and association requests. Cohorts are keyed by the
+digest of the canonical form of their definition (see `icees_db.canonical`),
+so equivalent definitions share one cohort.
+Names in the `name` table refer to cohorts by id.
+"""
+import json
+import zlib
+
+import numpy as np
+from sqlalchemy import Sequence, String, cast, func, insert, literal, literal_column, select, update
+from sqlalchemy.exc import IntegrityError
+
+from .bitmap import OPERATORS
+from .canonical import canonical_features, encode, request_digest
+
+
+def cohort_digest(table, year, features) -> bytes:
+    """Key of a cohort definition, computed on its canonical form."""
+    return request_digest(table, year, canonical_features(table, features))
+
+
+def encode_members(ids) -> bytes:
+    """Sorted ids as zlib-compressed int64 deltas."""
+    ids = np.asarray(ids, dtype=np.int64)
+    return zlib.compress(np.diff(ids, prepend=0).tobytes())
+
+
+def decode_members(data):
+    return np.cumsum(np.frombuffer(zlib.decompress(data), dtype=np.int64))
+
+
+def sql_filter(column, constraint):
+    """SQL condition of a feature constraint (see `icees_db.bitmap.select_values`)."""
+    op = constraint["operator"]
+    if op in OPERATORS:
+        return OPERATORS[op](column, constraint["value"])
+    if op == "in":
+        return column.in_(constraint["values"])
+    if op == "between":
+        return column.between(constraint["value_a"], constraint["value_b"])
+    raise ValueError(f"Unsupported operator '{op}'")
+
+
+def evaluate(conn, metadata, table, year, features):
+    """Sorted ids of the rows of a cohort, queried from the feature table."""
+    t = metadata.tables[table]
+    id_col = t.c[table[0].upper() + table[1:] + "Id"]
+    ids = conn.execute(
+        select(id_col)
+        .where(
+            t.c.year == year,
+            *(sql_filter(t.c[feature], constraint) for feature, constraint in features.items()),
+        )
+        .order_by(id_col)
+    ).scalars().all()
+    return np.asarray(ids, dtype=np.int64)
+
+
+def _insert_cohort(conn, cohort, values):
+    """Insert a cohort row with a new id.
+
+    The id is the next value of `cohort_id_seq`, or on databases without
+    sequences (sqlite) derived from max(rowid) by the INSERT itself, so it is
+    read under the same write lock that the row is written with.
+    """
+    if conn.dialect.supports_sequences:
+        n = conn.execute(Sequence("cohort_id_seq").next_value()).scalar()
+        conn.execute(insert(cohort).values(cohort_id=f"COHORT:{n}", **values))
+        return
+    n = func.coalesce(func.max(literal_column("rowid")), 0) + 1
+    conn.execute(insert(cohort).from_select(
+        ["cohort_id", *values],
+        select(
+            literal("COHORT:") + cast(n, String),
+            *(literal(value, cohort.c[name].type) for name, value in values.items()),
+        ).select_from(cohort),
+    ))
+
+
+def get_or_create(conn, metadata, table, year, features):
+    """Materialise a cohort, or reuse the cohort of an equivalent definition.
+
+    Returns the cohort id and its sorted member ids. Members cleared by
+    `invalidate` are re-evaluated. Digests are unique, so when a concurrent
+    call stores the same definition first, its cohort is returned.
+    """
+    features = canonical_features(table, features)
+    cohort = metadata.tables["cohort"]
+    key = cohort_digest(table, year, features)
+    query = select(cohort.c.cohort_id, cohort.c.members).where(cohort.c.digest == key)
+    row = conn.execute(query).first()
+    if row is not None and row.members is not None:
+        return row.cohort_id, decode_members(row.members)
+    ids = evaluate(conn, metadata, table, year, features)
+    if row is not None:
+        conn.execute(
+            update(cohort)
+            .where(cohort.c.cohort_id == row.cohort_id)
+            .values(size=len(ids), members=encode_members(ids))
+        )
+        return row.cohort_id, ids
+    try:
+        with conn.begin_nested():
+            _insert_cohort(conn, cohort, {
+                "table": table,
+                "year": year,
+                "size": len(ids),
+                "features": encode(features),
+                "digest": key,
+                "members": encode_members(ids),
+            })
+    except IntegrityError:
+        row = conn.execute(query).first()
+        return row.cohort_id, decode_members(row.members)
+    return conn.execute(query).first().cohort_id, ids
+
+
+def get_cohort(conn, metadata, cohort_id):
+    """Definition and members of a cohort: (table, year, features, ids), or None."""
+    cohort = metadata.tables["cohort"]
+    row = conn.execute(select(cohort).where(cohort.c.cohort_id == cohort_id)).first()
+    if row is None:
+        return None
+    features = json.loads(row.features)
+    if row.members is None:
+        _, ids = get_or_create(conn, metadata, row.table, row.year, features)
+    else:
+        ids = decode_members(row.members)
+    return row.table, row.year, features, ids
+
+
+def add_name(conn, metadata, name, cohort_id, table):
+    """Name a cohort, replacing an existing name."""
+    name_table = metadata.tables["name"]
+    conn.execute(name_table.delete().where(name_table.c.name == name))
+    conn.execute(insert(name_table).values(name=name, cohort_id=cohort_id, table=table))
+
+
+def cohort_id_by_name(conn, metadata, name):
+    name_table = metadata.tables["name"]
+    return conn.execute(
+        select(name_table.c.cohort_id).where(name_table.c.name == name)
+    ).scalar()
+
+
+def invalidate(conn, metadata, years):
+    """Clear the members of the cohorts of reloaded years.
+
+    Cohort ids and names stay valid; members are re-evaluated on next use.
+    """
+    cohort = metadata.tables["cohort"]
+    return conn.execute(
+        update(cohort).where(cohort.c.year.in_(years)).values(members=None)
+    ).rowcount
@@ -0,0 +1,172 @@
+"""Columnar in-memory feature store.
+
+Every feature column of a (table, year) is dictionary-encoded into an array
+of small integer codes indexing an array of its values. The dictionary of a
+feature with options in the catalogue lists those options first, so codes
+are stable across years; values outside the options, and the values of
+features without options, follow in sorted order. Missing values get the
+last code, `len(values)`.
+
+Counts and contingency tables are `np.bincount`s over the codes, and cohort
+constraints become lookups of the codes in a boolean table per feature.
+"""
+import argparse
+from functools import lru_cache
+import logging
+import sys
+
+import numpy as np
+import pandas as pd
+
+from .bitmap import select_values
+from .canonical import canonical_features
+from .dbutils import read_table_years
+from .features import get_feature_index
+
+logger = logging.getLogger(__name__)
+
+
+def code_dtype(nvalues):
+    """Smallest unsigned integer type for `nvalues` codes and a missing code."""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if nvalues < np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def encode(series, feature=None):
+    """Dictionary-encode a column: (values, codes)."""
+    observed = pd.unique(series.dropna())
+    if feature is not None and feature.options is not None:
+        options = list(feature.options)
+        known = set(options)
+        extra = sorted(value for value in observed if value not in known)
+        values = options + extra
+    else:
+        values = sorted(observed)
+    if feature is not None and feature._type is int:
+        values = np.array(values, dtype=np.int64)
+    elif feature is not None and feature._type is str:
+        values = np.array(values, dtype=str)
+    else:
+        values = np.array(values)
+    codes = pd.Categorical(series, categories=values).codes
+    codes = np.where(codes < 0, len(values), codes).astype(code_dtype(len(values)))
+    return values, codes
+
+
+class ColumnStore:
+    """Encoded feature columns of every (table, year).
+
+    `ids[(table, year)]` holds the row ids and `columns[(table, year)][feature]`
+    a (values, codes) pair with one code per row.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.columns = {}
+
+    def add(self, table, year, df):
+        """Encode the rows of one table and year (a data frame ordered by id)."""
+        id_col = table[0].upper() + table[1:] + "Id"
+        catalogue = get_feature_index()[table]
+        self.ids[(table, year)] = df[id_col].to_numpy(dtype=np.int64)
+        self.columns[(table, year)] = {
+            name: encode(df[name], catalogue.get(name))
+            for name in df.columns
+            if name not in (id_col, "year")
+        }
+
+    def column(self, table, year, feature):
+        """(values, codes) of a feature."""
+        try:
+            return self.columns[(table, year)][feature]
+        except KeyError:
+            raise ValueError(f"No column {table}.{feature} in {year}") from None
+
+    def mask(self, table, year, cohort_features):
+        """Boolean mask of the rows that satisfy every constraint.
+
+        Constraint values are cast to the feature types first, as for
+        `icees_db.bitmap.BitmapIndex.cohort`.
+        """
+        mask = np.ones(len(self.ids[(table, year)]), dtype=bool)
+        for feature, constraint in canonical_features(table, cohort_features).items():
+            values, codes = self.column(table, year, feature)
+            # the missing code never matches
+            selected = np.append(select_values(values, constraint), False)
+            mask &= selected[codes]
+        return mask
+
+    def members_mask(self, table, year, ids):
+        """Boolean mask of the rows of a materialised cohort (sorted ids)."""
+        row_ids = self.ids[(table, year)]
+        i = np.minimum(np.searchsorted(ids, row_ids), max(len(ids) - 1, 0))
+        return (ids[i] == row_ids) if len(ids) else np.zeros(len(row_ids), dtype=bool)
+
+    def count(self, table, year, cohort_features):
+        """Size of a cohort."""
+        return int(np.count_nonzero(self.mask(table, year, cohort_features)))
+
+    def value_counts(self, table, year, cohort_features, feature):
+        """Counts of each value of `feature` within a cohort: {value: count}."""
+        values, codes = self.column(table, year, feature)
+        if cohort_features:
+            codes = codes[self.mask(table, year, cohort_features)]
+        counts = np.bincount(codes, minlength=len(values) + 1)[:len(values)]
+        return dict(zip(values.tolist(), counts.tolist()))
+
+    def contingency(self, table, year, cohort_features, feature_a, feature_b):
+        """Contingency table of two features within a cohort.
+
+        Returns the values of `feature_a`, the values of `feature_b` and the
+        matrix of counts. Rows missing either feature are not counted.
+        """
+        values_a, codes_a = self.column(table, year, feature_a)
+        values_b, codes_b = self.column(table, year, feature_b)
+        if cohort_features:
+            mask = self.mask(table, year, cohort_features)
+            codes_a, codes_b = codes_a[mask], codes_b[mask]
+        na, nb = len(values_a) + 1, len(values_b) + 1
+        combined = codes_a.astype(np.int64) * nb + codes_b
+        counts = np.bincount(combined, minlength=na * nb).reshape(na, nb)
+        return values_a, values_b, counts[:-1, :-1]
+
+    def memory_usage(self):
+        """Bytes held per table."""
+        usage = {}
+        for (table, year), columns in self.columns.items():
+            nbytes = self.ids[(table, year)].nbytes + sum(
+                values.nbytes + codes.nbytes for values, codes in columns.values()
+            )
+            usage[table] = usage.get(table, 0) + nbytes
+        return usage
+
+    def log_memory_usage(self):
+        for table, nbytes in self.memory_usage().items():
+            nrows = sum(len(ids) for (t, _), ids in self.ids.items() if t == table)
+            logger.info(f"{table}: {nrows} rows, {nbytes / 2**20:.1f} MB")
+
+
+def build(tables=None):
+    """Load the feature tables from the database into a column store."""
+    store = ColumnStore()
+    for table, year, df in read_table_years(tables):
+        store.add(table, year, df)
+        logger.info(f"encoded {len(df)} {table} rows of {year}")
+    store.log_memory_usage()
+    return store
+
+
+@lru_cache(maxsize=None)
+def get_column_store():
+    """Column store of all feature tables, loaded on first use."""
+    return build()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='ICEES DB column store')
+    parser.add_argument('--table', type=str, action='append', help='only load these tables (repeatable)')
+    args = parser.parse_args(sys.argv[1:])
+    build(args.table)
@@ -1,60 +1,315 @@
 """Database tools."""
 from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import os
 from pathlib import Path
-from time import sleep
+import sqlite3
+from threading import Lock, Thread
+from time import perf_counter, sleep
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine import Connection
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
 
 db = os.environ.get("ICEES_DB", "sqlite")
 
+SQLITE_READONLY = db == "sqlite" and os.environ.get("SQLITE_READONLY", "0") == "1"
+
 engine = None
 
 
+class PoolMetrics:
+    """Counters of the connection pool."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.checkouts = 0
+        self.checkout_wait_seconds = 0.0
+        self.checkout_wait_max_seconds = 0.0
+        self.active_connections = 0
+        self.connections_opened = 0
+        self.connection_errors = 0
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_wait_seconds += seconds
+            self.checkout_wait_max_seconds = max(self.checkout_wait_max_seconds, seconds)
+
+    def add(self, name, value=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: value
+                for name, value in vars(self).items()
+                if not name.startswith("_")
+            }
+
+
+metrics = PoolMetrics()
+
+
+# PRAGMAs for loading a fresh sqlite database: the load can be rerun if it
+# fails, so durability is traded for speed
+SQLITE_BULK_PRAGMAS = {
+    "synchronous": "OFF",
+    "cache_size": -1048576,  # 1 GiB
+    "mmap_size": 1 << 30,
+    "temp_store": "MEMORY",
+}
+
+
+def _register_sqlite_events(engine):
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        # read from the environment so that loader processes inherit it
+        if os.environ.get("SQLITE_PROFILE") == "bulk":
+            cursor = dbapi_connection.cursor()
+            for name, value in SQLITE_BULK_PRAGMAS.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+            cursor.close()
+
+
+def set_sqlite_profile(profile):
+    """Switch sqlite connections to the "bulk" or the default "safe" profile.
+
+    The bulk profile uses WAL journaling and the SQLITE_BULK_PRAGMAS; the
+    safe profile restores the sqlite defaults (rollback journal, synchronous
+    FULL). Pooled connections are discarded so the change applies to all.
+    """
+    if profile not in ("bulk", "safe"):
+        raise ValueError(f"Unsupported sqlite profile '{profile}'")
+    os.environ["SQLITE_PROFILE"] = profile
+    engine = get_db_connection()
+    engine.dispose()
+    with engine.connect() as conn:
+        conn.exec_driver_sql(
+            "PRAGMA journal_mode = " + ("WAL" if profile == "bulk" else "DELETE")
+        )
+
+
+@contextmanager
+def sqlite_bulk_load():
+    """Use the bulk sqlite profile for the duration of the block.
+
+    Does nothing on other databases.
+    """
+    if db != "sqlite":
+        yield
+        return
+    set_sqlite_profile("bulk")
+    try:
+        yield
+    finally:
+        set_sqlite_profile("safe")
+
+
+def _register_pool_events(engine):
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        metrics.add("connections_opened")
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.add("active_connections")
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        metrics.add("active_connections", -1)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.is_disconnect:
+            metrics.add("connection_errors")
+
+
+def pool_options():
+    """Connection pool settings from the environment."""
+    return {
+        "pool_pre_ping": True,
+        "pool_size": int(os.environ.get("POOL_SIZE", 10)),
+        "max_overflow": int(os.environ.get("MAX_OVERFLOW", 0)),
+        "pool_timeout": float(os.environ.get("POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("POOL_RECYCLE", -1)),
+    }
+
+
+def pool_capacity():
+    """Connections the pool hands out at once: POOL_SIZE + MAX_OVERFLOW."""
+    options = pool_options()
+    return options["pool_size"] + max(options["max_overflow"], 0)
+
+
+def _sqlite_readonly_creator(path):
+    """Connection factory for serving a sqlite database read-only.
+
+    The file is opened immutable (no locking or change detection) and fully
+    memory-mapped, so readers share its pages through the OS page cache.
+    Connections may be used by any thread, one at a time, as the pool hands
+    them out.
+    """
+    uri = Path(path).resolve().as_uri() + "?mode=ro&immutable=1"
+    def connect():
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA mmap_size = {os.path.getsize(path)}")
+        return conn
+    return connect
+
+
 def get_db_connection():
-    """Get database connection."""
+    """Get database connection.
+
+    With SQLITE_READONLY=1, a sqlite database is served read-only: opened
+    immutable and memory-mapped, from a pool of POOL_SIZE connections that
+    opens more as needed rather than making threads wait. The file cannot
+    change, so connections are not pinged.
+
+    Connections are pooled with a pre-ping health check on checkout. The pool
+    is configured with POOL_SIZE, MAX_OVERFLOW, POOL_TIMEOUT (seconds to wait
+    for a free connection) and POOL_RECYCLE (seconds after which a connection
+    is replaced, -1 for never).
+    """
     global engine
     if engine is None:
-        if db == "sqlite":
+        if SQLITE_READONLY:
+            DB_PATH = Path(os.environ["DB_PATH"])
+            engine = create_engine(
+                "sqlite://",
+                creator=_sqlite_readonly_creator(DB_PATH / 'example.db'),
+                poolclass=QueuePool,
+                pool_size=int(os.environ.get("POOL_SIZE", 10)),
+                max_overflow=-1,
+            )
+        elif db == "sqlite":
             DB_PATH = Path(os.environ["DB_PATH"])
             engine = create_engine(
                 f"sqlite:///{DB_PATH / 'example.db'}?check_same_thread=False",
+                **pool_options(),
             )
+            _register_sqlite_events(engine)
         elif db == "postgres":
             serv_host = os.environ["ICEES_HOST"]
             serv_port = os.environ["ICEES_PORT"]
             engine = create_engine(
                 f"postgresql+psycopg2://icees_dbuser:icees_dbpass@{serv_host}:{serv_port}/icees_database",
-                pool_size=int(os.environ.get("POOL_SIZE", 10)),
-                max_overflow=int(os.environ.get("MAX_OVERFLOW", 0)),
+                **pool_options(),
             )
         else:
             raise ValueError(f"Unsupported database '{db}'")
+        _register_pool_events(engine)
 
     return engine
 
 
-@contextmanager
-def DBConnection() -> Connection:
-    """Database connection."""
+def _dispose_in_child():
+    # pooled connections must not be shared with forked processes
+    if engine is not None:
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_dispose_in_child)
+
+
+def _connect(checkout):
+    """Check out a connection, retrying with exponential backoff."""
     engine = get_db_connection()
     sleep_sec = 0.5
     while True:
+        start = perf_counter()
         try:
-            conn: Connection = engine.connect()
-            break
+            conn = checkout(engine)
+            metrics.record_wait(perf_counter() - start)
+            return conn
         except OperationalError as err:
+            metrics.add("connection_errors")
             sleep_sec *= 2
             if sleep_sec > 16:
                 raise err
             print(
-                "Failed to connect to PostgreSQL. "
+                "Failed to connect to the database. "
                 f"Retrying in {sleep_sec} seconds..."
             )
             sleep(sleep_sec)
+
+
+@contextmanager
+def DBConnection() -> Connection:
+    """Database connection."""
+    conn: Connection = _connect(lambda engine: engine.connect())
     try:
         yield conn
     finally:
         conn.close()
+
+
+@contextmanager
+def DBAPIConnection():
+    """Pooled DBAPI (sqlite3/psycopg2) connection.
+
+    For bulk loading with cursor.executemany or COPY. Committed on exit,
+    rolled back on error, and returned to the pool either way.
+    """
+    conn = _connect(lambda engine: engine.raw_connection())
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def get_pool_metrics():
+    """Current pool counters and pool status."""
+    result = metrics.snapshot()
+    if engine is not None:
+        pool = engine.pool
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            # only QueuePool has these
+            if callable(getattr(pool, name, None)):
+                result[f"pool_{name}"] = getattr(pool, name)()
+    return result
+
+
+def metrics_text():
+    """Pool metrics in the Prometheus text exposition format."""
+    lines = []
+    for name, value in get_pool_metrics().items():
+        metric = f"icees_db_{name}"
+        kind = "counter" if name in (
+            "checkouts", "checkout_wait_seconds",
+            "connections_opened", "connection_errors",
+        ) else "gauge"
+        lines.append(f"# TYPE {metric} {kind}")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=None):
+    """Serve `metrics_text` over HTTP from a daemon thread.
+
+    The port defaults to METRICS_PORT (9100).
+    """
+    if port is None:
+        port = int(os.environ.get("METRICS_PORT", 9100))
+    server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,20 +1,32 @@
 """Database utilities."""
 import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import csv
-from contextlib import contextmanager
+import hashlib
 import io
+from itertools import islice
+import json
 import logging
 import os
 from pathlib import Path
 import sqlite3
 import sys
+import time
 
 import pandas as pd
 import psycopg2
-from sqlalchemy import Index
-
-from .db import DBConnection
-from .features import features
+from sqlalchemy import Index, MetaData, inspect, select, text
+import yaml
+
+from .db import DBAPIConnection, DBConnection, pool_capacity
+from .binning import get_binner
+from .features import get_feature_index
+from .partition import (
+    PARTITION_BY_YEAR, create_partitions, drop_partitions, is_partitioned,
+    partition_name, partition_table, partitions, reflect, replace_view,
+    storage_tables,
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -30,88 +42,404 @@ def createargs(args):
 
 
 def create(metadata):
-    """Build database schema."""
+    """Build database schema.
+
+    Partitioned tables are created without partitions; on SQLite they are
+    views of their (not yet created) partitions.
+    """
+    with DBConnection() as conn:
+        with conn.begin() as trans:
+            if conn.dialect.name != "sqlite":
+                metadata.create_all(conn)
+                return
+            views = [t for t in metadata.tables.values() if is_partitioned(t)]
+            metadata.create_all(conn, tables=[t for t in metadata.tables.values() if t not in views])
+            for table in views:
+                replace_view(conn, table)
+
+
+def drop(metadata):
+    """Drop the database schema, with the partitions of partitioned tables."""
     with DBConnection() as conn:
         with conn.begin() as trans:
-            metadata.create_all(conn)
+            if conn.dialect.name != "sqlite":
+                metadata.drop_all(conn)
+                return
+            views = [t for t in metadata.tables.values() if is_partitioned(t)]
+            drop_partitions(conn, metadata, {t.name: partitions(conn, t.name) for t in views})
+            for table in views:
+                conn.execute(text(f'DROP VIEW IF EXISTS "{table.name}"'))
+            metadata.drop_all(conn, tables=[t for t in metadata.tables.values() if t not in views])
+
+
+def add_missing_columns(metadata):
+    """Add columns that are in `metadata` but not yet in the database tables."""
+    with DBConnection() as conn:
+        with conn.begin() as trans:
+            inspector = inspect(conn)
+            for table in metadata.tables.values():
+                added = False
+                for name in storage_tables(conn, table):
+                    existing = {col["name"] for col in inspector.get_columns(name)}
+                    for column in table.c:
+                        if column.name not in existing:
+                            logger.info(f"adding column {name}.{column.name}")
+                            conn.execute(text('ALTER TABLE "{0}" ADD COLUMN "{1}" {2}'.format(
+                                name,
+                                column.name,
+                                column.type.compile(dialect=conn.dialect),
+                            )))
+                            added = True
+                if added and is_partitioned(table) and conn.dialect.name == "sqlite":
+                    replace_view(conn, table)
+
+
+def delete_years(metadata, table_years):
+    """Delete the rows of the given years, `table_years` maps table to years.
+
+    The partitions of partitioned tables are dropped and recreated empty.
+    """
+    with DBConnection() as conn:
+        with conn.begin() as trans:
+            drop_partitions(conn, metadata, table_years)
+            create_partitions(conn, metadata, table_years)
+            for table, years in table_years.items():
+                if years and not is_partitioned(metadata.tables[table]):
+                    t = metadata.tables[table]
+                    result = conn.execute(t.delete().where(t.c.year.in_(sorted(years))))
+                    logger.info(f"deleted {result.rowcount} {table} rows of {sorted(years)}")
+
+
+def analyze(tables):
+    """Refresh planner statistics of the given tables.
+
+    On SQLite, the partitions of partitioned tables (views) are analyzed.
+    """
+    with DBConnection() as conn:
+        with conn.begin() as trans:
+            for table in tables:
+                names = [table]
+                if PARTITION_BY_YEAR and conn.dialect.name == "sqlite":
+                    names = list(partitions(conn, table).values()) or names
+                for name in names:
+                    conn.execute(text(f'ANALYZE "{name}"'))
+
+
+def read_table_years(tables=None):
+    """Yield (table, year, data frame ordered by id) of the feature tables."""
+    metadata = MetaData()
+    with DBConnection() as conn:
+        reflect(conn, metadata)
+        for name, table in metadata.tables.items():
+            if name in non_feature_tables or (tables is not None and name not in tables):
+                continue
+            id_col = table.c[name[0].upper() + name[1:] + "Id"]
+            years = conn.execute(select(table.c.year).distinct()).scalars().all()
+            for year in sorted(year for year in years if year is not None):
+                yield name, year, pd.read_sql(
+                    select(table).where(table.c.year == year).order_by(id_col),
+                    conn,
+                )
 
 
 def read_headers(file_path, table_name):
-    with open(file_path, "r") as stream:
-        reader = csv.DictReader(stream)
+    """Column names of a shard, read from its header line only."""
+    if Path(file_path).suffix == ".parquet":
+        from .staging import read_parquet_headers  # requires pyarrow
+        return read_parquet_headers(file_path)
+    with open(file_path, "r", newline="") as stream:
+        header = next(csv.reader(stream), [])
+
+    index = table_name[0].upper() + table_name[1:] + "Id"
+    return [
+        col if col != "index" else index
+        for col in header
+    ]
+
+
+INDEX_WORKERS = int(os.environ.get("INDEX_WORKERS", 1))
 
-        index = table_name[0].upper() + table_name[1:] + "Id"
-        row = next(reader)
-        return [
-            col if col != "index" else index
-            for col in row.keys()
-        ]
+non_feature_tables = ["cohort", "name", "cache", "cache_count", "manifest"]
 
 
-def create_indices(metadata):
-    """Build database indexes."""
+def read_index_profile(file_path):
+    """Read a usage profile of features that get (year, feature) indexes.
+
+    The file (YAML or JSON) maps each table to a list of features, or to a
+    mapping of feature to query count.
+    """
+    with open(file_path, "r") as stream:
+        profile = yaml.safe_load(stream)
+    return {
+        table: set(table_features)
+        for table, table_features in profile.items()
+    }
+
+
+def index_name(name):
+    """An index name, shortened to postgres' 63 characters with a hash suffix."""
+    if len(name) <= 63:
+        return name
+    digest = hashlib.md5(name.encode()).hexdigest()[:8]
+    return name[:54] + "_" + digest
+
+
+def index_specs(metadata, composite_features=None):
+    """List (name, table, columns) for the feature table indexes.
+
+    Every feature column gets a single column index. Composite
+    (year, feature) indexes are limited to `composite_features` (a mapping of
+    table to features) when it is given. Index names depend only on the table
+    and columns, so they are stable across runs with different profiles and
+    when columns are added. Tables partitioned by year get neither a year
+    index nor composite indexes, as each partition holds one year.
+    """
     tables = metadata.tables
-    itrunc = 0
-    def truncate(a, length=63):
-        logger.info("creating index " + a)
-        nonlocal itrunc
-        prefix = "index" + str(itrunc)
-        itrunc += 1
-        return prefix + a[:63-len(prefix)]
+    specs = []
+
+    for table, table_features in tables.items():
+      if table not in non_feature_tables:
+        id_col = table[0].upper() + table[1:] + "Id"
+        partitioned = is_partitioned(table_features)
+        specs.append((index_name(f"index_{table}_{id_col}"), table, [id_col]))
+        if not partitioned:
+            specs.append((index_name(f"index_{table}_year"), table, ["year"]))
+        cols = list(map(lambda a : a.name, table_features.c))
+        for feature in cols:
+            name = index_name(f"index_{table}_{feature}")
+            composite_name = index_name(f"index_year_{table}_{feature}")
+            if feature in (id_col, "year"):
+                # already covered by the two indexes above
+                continue
+            specs.append((name, table, [feature]))
+            if partitioned:
+                continue
+            if composite_features is None or feature in composite_features.get(table, ()):
+                specs.append((composite_name, table, ["year", feature]))
+    return specs
+
+
+def existing_indices(conn, table_names):
+    """Names of the valid indexes on the given tables."""
+    if db_ == "postgres":
+        # skip indexes left invalid by a failed CREATE INDEX CONCURRENTLY
+        result = conn.execute(text(
+            "SELECT c.relname FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "JOIN pg_class t ON t.oid = i.indrelid "
+            "WHERE i.indisvalid AND t.relname = ANY(:tables)"
+        ), {"tables": list(table_names)})
+        return {row[0] for row in result}
+    inspector = inspect(conn)
+    return {
+        index["name"]
+        for table in table_names
+        for index in inspector.get_indexes(table)
+    }
+
+
+def create_indices(
+        metadata,
+        workers=INDEX_WORKERS,
+        concurrently=False,
+        composite_features=None,
+):
+    """Build database indexes.
+
+    Indexes that already exist are skipped. With `workers` > 1 (postgres
+    only) indexes are built in parallel, each on its own connection, by at
+    most as many workers as the pool has connections. With
+    `concurrently` (postgres only) they are built with CREATE INDEX
+    CONCURRENTLY, so the tables stay writable during the build, except on
+    partitioned tables, which postgres does not support. On SQLite, the
+    indexes of partitioned tables are built on each partition, named with
+    the year as a suffix.
+    """
+    tables = dict(metadata.tables)
+    specs = index_specs(metadata, composite_features)
     with DBConnection() as conn:
-        with conn.begin() as trans:
+        if conn.dialect.name == "sqlite":
+            partitioned = {name for name, table in tables.items() if is_partitioned(table)}
+            for name in partitioned:
+                for year in partitions(conn, name):
+                    table = partition_table(tables[name], year)
+                    tables[table.name] = table
+            specs = [
+                spec
+                for spec in specs if spec[1] not in partitioned
+            ] + [
+                (f"{index_name}_{year}", partition_name(table, year), columns)
+                for index_name, table, columns in specs if table in partitioned
+                for year in sorted(partitions(conn, table))
+            ]
+        existing = existing_indices(conn, {table for _, table, _ in specs})
+    todo = [spec for spec in specs if spec[0] not in existing]
+    logger.info(f"creating {len(todo)} indexes, {len(specs) - len(todo)} already exist")
+
+    postgres_options = {}
+    if db_ == "postgres" and concurrently:
+        postgres_options["postgresql_concurrently"] = True
+    indices = [
+        Index(
+            name,
+            *(tables[table].c[col] for col in columns),
+            **({} if is_partitioned(tables[table]) else postgres_options),
+        )
+        for name, table, columns in todo
+    ]
+
+    if db_ != "postgres" or (workers <= 1 and not concurrently):
+        with DBConnection() as conn:
+            with conn.begin() as trans:
+                for index in indices:
+                    logger.info("creating index " + index.name)
+                    index.create(conn)
+        return
+
+    def build(index):
+        logger.info("creating index " + index.name)
+        with DBConnection() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            try:
+                index.create(conn)
+            except Exception:
+                if index.kwargs.get("postgresql_concurrently"):
+                    conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+                raise
+
+    # more workers than pooled connections would time out waiting for one
+    workers = max(1, min(workers, pool_capacity()))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(build, indices):
+            pass
 
-            for table, table_features in tables.items():
-              if table not in ["cohort", "name"]:
-                id_col = table[0].upper() + table[1:] + "Id"
-                Index(truncate(table + "_" + id_col), tables[table].c[id_col]).create(conn)
-                Index(truncate(table + "_year"), tables[table].c.year).create(conn)
-                cols = list(map(lambda a : a.name, table_features.c))
-                for feature in cols:
-                    Index(truncate(table + "_" + feature), tables[table].c[feature]).create(conn)
-                    Index(truncate(table + "_year_" + feature), tables[table].c.year, tables[table].c[feature]).create(conn)
-#                    for feature2 in cols:
-#                        Index(truncate(table + "_year_" + feature + "_" + feature2), tables[table].c.year, tables[table].c[feature], tables[table].c[feature2]).create(conn)
 
-    
 def insertargs(args):
-    insert(args.input_file, args.table_name)
+    insert(
+        args.input_file,
+        args.table_name,
+        chunk_size=args.chunk_size,
+        method=args.method,
+        coerce=args.coerce,
+        binned=args.bin,
+    )
+
+
+def validateargs(args):
+    report = validate(args.input_file, args.table_name, chunk_size=args.chunk_size, binned=args.bin)
+    print(json.dumps(report, indent=4))
+
+
+def _to_float(s):
+    """Cast strings to float, NaN where invalid.
+
+    pd.to_numeric only finds the invalid values; its fast parser does not
+    round-trip every float exactly, so valid values are cast with astype.
+    """
+    valid = pd.to_numeric(s, errors="coerce").notna()
+    return s.where(valid, None).astype(float)
+
+
+def _to_int(s):
+    """Cast strings to nullable integers, NA where invalid or fractional."""
+    s = pd.to_numeric(s, errors="coerce")
+    return s.where(s % 1 == 0).astype(pd.Int64Dtype())
 
 
 type_dict = {
-    "integer": lambda s : s.astype(pd.Int64Dtype()),
-    "string": lambda s : s.astype(str, skipna=True)
+    int: _to_int,
+    float: _to_float,
+    str: lambda s : s.astype(object),
 }
 
 db_ = os.environ.get("ICEES_DB", "sqlite")
 
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", 10000))
 
-@contextmanager
-def db_connections():
-    """Database connection context manager."""
-    if db_ == "sqlite":
-        con = sqlite3.connect(Path(os.environ["DB_PATH"]) / "example.db")
-    elif db_ == "postgres":
-        con = psycopg2.connect(
-            host=os.environ["ICEES_HOST"],
-            database="icees_database",
-            user="icees_dbuser",
-            password="icees_dbpass",
-        )
-    else:
-        raise ValueError(f"Unsupported database '{db_}'")
+LOAD_METHOD = os.environ.get("LOAD_METHOD", "insert")
 
-    yield con
+COERCE = os.environ.get("COERCE", "0") == "1"
 
-    con.commit()
-    con.close()
+BIN_FEATURES = os.environ.get("BIN_FEATURES", "0") == "1"
 
 
-def insert(file_path, table_name):
-    """Insert data from file into table."""
+def db_connections():
+    """Database connection context manager.
+
+    A DBAPI connection checked out from the shared pool in `icees_db.db`.
+    """
+    return DBAPIConnection()
+
+
+def insert(
+        file_path,
+        table_name,
+        chunk_size=CHUNK_SIZE,
+        method=LOAD_METHOD,
+        coerce=COERCE,
+        binned=BIN_FEATURES,
+):
+    """Insert data from file into table.
+
+    `method` is either "insert" (executemany, any database) or "copy"
+    (COPY FROM STDIN, postgres only). With `coerce`, CSV columns are cast and
+    validated against the feature types with `coerce_columns`, and rejected
+    values are logged and loaded as NULL. With `binned`, columns of features
+    with bin edges in bins.json hold raw values that are binned first (see
+    `icees_db.binning`), and coerced. Returns the number of rows inserted.
+    Parquet files written by `icees_db.staging` are loaded from their Arrow
+    record batches (already typed) instead of being parsed as CSV; they are
+    coerced and binned when they are staged, so a Parquet file that was not
+    staged with coercion is rejected when `coerce` or `binned` is set.
+    """
+    parquet = Path(file_path).suffix == ".parquet"
+    if parquet:
+        from . import staging  # requires pyarrow
+        loaders = {"insert": staging.insert_batches, "copy": staging.copy_batches}
+    else:
+        loaders = {"insert": _insert, "copy": _copy}
+    if method not in loaders:
+        raise ValueError(f"Unsupported load method '{method}'")
+    if method == "copy" and db_ != "postgres":
+        raise ValueError(f"Load method 'copy' is not supported on '{db_}'")
+    load = loaders[method]
+    if parquet and (coerce or binned) and not staging.is_coerced(file_path):
+        raise ValueError(
+            f"{file_path} was not staged with coercion; stage it again with COERCE=1"
+        )
+    if parquet or not (coerce or binned):
+        with db_connections() as con:
+            with open(file_path, "rb" if parquet else "r") as stream:
+                return load(table_name, con, stream, chunk_size=chunk_size)
+    report = defaultdict(Counter)
     with db_connections() as con:
         with open(file_path, "r") as stream:
-            _insert(table_name, con, stream)
+            nrows = load(table_name, con, stream, chunk_size=chunk_size, report=report, binned=binned)
+    log_report(file_path, report)
+    return nrows
+
+
+def validate(file_path, table_name, chunk_size=CHUNK_SIZE, binned=BIN_FEATURES):
+    """Report rejected values of a CSV file without loading it.
+
+    Returns a mapping of column to {rejected value: count}.
+    """
+    report = defaultdict(Counter)
+    with open(file_path, "r") as stream:
+        _, chunks = _read_coerced_chunks(table_name, stream, chunk_size, report, binned)
+        for _ in chunks:
+            pass
+    log_report(file_path, report)
+    return {col: dict(values) for col, values in report.items()}
+
+
+def log_report(file_path, report):
+    """Log a per-column summary of rejected values."""
+    for col, values in report.items():
+        examples = ", ".join(f"{value!r}: {count}" for value, count in values.most_common(5))
+        logger.warning(
+            f"{file_path}: {col}: {sum(values.values())} rejected values ({examples})"
+        )
 
 
 def removeDotZero(s):
@@ -125,34 +453,223 @@ def emptyStringToNone(s):
     return s if s != "" else None
 
 
-def _insert(table_name, con: sqlite3.Connection, stream: io.TextIOBase):
-    """Insert data from file into table."""
+def _read_chunks(table_name, stream: io.TextIOBase, chunk_size=CHUNK_SIZE):
+    """Read normalised rows from a CSV stream in batches.
+
+    Returns the database column names (with "index" renamed to the table id)
+    and a generator of lists of at most `chunk_size` row tuples. The columns
+    are None if the stream is empty.
+    """
     reader = csv.DictReader(stream)
-    to_db = []
-    columns = None
+    if reader.fieldnames is None:
+        return None, iter(())
     index = table_name[0].upper() + table_name[1:] + "Id"
-    for row in reader:
-        if not columns:
-            columns = [
-                col if col != "index" else index
-                for col in row.keys()
+    columns = [
+        col if col != "index" else index
+        for col in reader.fieldnames
+    ]
+    keys = [col if col != index else "index" for col in columns]
+
+    def chunks():
+        while True:
+            to_db = [
+                tuple(
+                    emptyStringToNone(removeDotZero(row.get(key)))
+                    for key in keys
+                )
+                for row in islice(reader, chunk_size)
             ]
-        to_db.append(tuple(
-            emptyStringToNone(removeDotZero(row.get(col if col != index else "index")))
-            for col in columns
-        ))
+            if not to_db:
+                break
+            yield to_db
 
-    cur = con.cursor()
+    return columns, chunks()
+
+
+def coerce_columns(df, table_name, report):
+    """Cast and validate the columns of a chunk of string-typed CSV data.
+
+    Each feature column is normalised (".0" suffix and empty strings), cast
+    with `type_dict` according to its `Feature._type`, and checked against
+    its `options`, one whole column at a time. Values that fail to cast or
+    are not valid options become NULL and are counted in `report`
+    (column -> Counter of rejected values).
+    """
+    types = get_feature_index()[table_name]
+    index = table_name[0].upper() + table_name[1:] + "Id"
+    result = {}
+    for col in df.columns:
+        raw = df[col].str.replace(r"\.0$", "", regex=True).replace("", None)
+        feature = types.get(col)
+        if feature is not None:
+            _type = feature._type
+        else:
+            _type = int if col in (index, "year") else str
+        values = type_dict[_type](raw)
+        rejected = raw.notna() & values.isna()
+        options = feature.options if feature is not None else None
+        if isinstance(options, range):
+            valid = values.between(options.start, options.stop - 1)
+            rejected |= values.notna() & ~valid.fillna(False).astype(bool)
+        elif options is not None:
+            rejected |= values.notna() & ~values.isin(options).fillna(False).astype(bool)
+        if rejected.any():
+            report[col].update(raw[rejected])
+            values = values.mask(rejected)
+        result[col] = values
+    df = pd.DataFrame(result)
+    return df.astype(object).where(df.notna(), None)
+
+
+def _read_coerced_chunks(table_name, stream: io.TextIOBase, chunk_size, report, binned=False):
+    """Read rows from a CSV stream in batches, coercing them with `coerce_columns`.
+
+    With `binned`, raw values are binned with `Binner.bin_frame` first.
+    Returns the same as `_read_chunks`.
+    """
+    header = next(csv.reader(stream), None)
+    if header is None:
+        return None, iter(())
+    index = table_name[0].upper() + table_name[1:] + "Id"
+    columns = [col if col != "index" else index for col in header]
+    reader = pd.read_csv(
+        stream,
+        header=None,
+        names=columns,
+        dtype=str,
+        keep_default_na=False,
+        chunksize=chunk_size,
+    )
+
+    binner = get_binner() if binned else None
+
+    def chunks():
+        for df in reader:
+            if binner is not None:
+                df = binner.bin_frame(df, table_name, report)
+            yield list(coerce_columns(df, table_name, report).itertuples(index=False, name=None))
+
+    return columns, chunks()
+
+
+def insert_query(table_name, columns):
+    """Parameterised INSERT statement for the given columns."""
     if db_ == "sqlite":
         placeholders = ", ".join("?" for _ in columns)
     else:
         placeholders = ", ".join("%s" for _ in columns)
-    query = "INSERT INTO {0} ({1}) VALUES ({2});".format(
+    return "INSERT INTO {0} ({1}) VALUES ({2});".format(
         table_name,
         ", ".join(f"\"{col}\"" for col in columns),
         placeholders,
     )
-    cur.executemany(query, to_db)
+
+
+def copy_query(table_name, columns):
+    """COPY FROM STDIN statement for CSV data with the given columns."""
+    return "COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)".format(
+        table_name,
+        ", ".join(f"\"{col}\"" for col in columns),
+    )
+
+
+def log_progress(table_name, nrows, start):
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"{table_name}: {nrows} rows inserted "
+        f"({nrows / elapsed if elapsed > 0 else 0:.0f} rows/sec)"
+    )
+
+
+def _read(table_name, stream, chunk_size, report, binned=False):
+    if report is None:
+        return _read_chunks(table_name, stream, chunk_size)
+    return _read_coerced_chunks(table_name, stream, chunk_size, report, binned)
+
+
+def insert_rows(cur, table_name, columns, rows):
+    """executemany an INSERT of `rows`.
+
+    With PARTITION_BY_YEAR on SQLite, rows are routed to the table of their
+    year, which must exist (see `icees_db.partition.create_partitions`).
+    """
+    if not (PARTITION_BY_YEAR and db_ == "sqlite"):
+        cur.executemany(insert_query(table_name, columns), rows)
+        return
+    i = columns.index("year")
+    by_year = defaultdict(list)
+    for row in rows:
+        by_year[row[i]].append(row)
+    if None in by_year:
+        raise ValueError(f"{len(by_year[None])} {table_name} rows without a year")
+    for year, year_rows in by_year.items():
+        cur.executemany(insert_query(partition_name(table_name, int(year)), columns), year_rows)
+
+
+def _insert(
+        table_name,
+        con: sqlite3.Connection,
+        stream: io.TextIOBase,
+        chunk_size=CHUNK_SIZE,
+        report=None,
+        binned=False,
+):
+    """Insert data from file into table.
+
+    Rows are read and inserted in batches of `chunk_size` and committed after
+    each batch, so memory use does not grow with the size of the file. If
+    `report` is given, rows are coerced with `coerce_columns` and rejected
+    values are counted into it; with `binned`, raw values of binned features
+    are binned before.
+    """
+    columns, chunks = _read(table_name, stream, chunk_size, report, binned)
+    if columns is None:
+        return 0
+
+    cur = con.cursor()
+
+    nrows = 0
+    start = time.perf_counter()
+    for to_db in chunks:
+        insert_rows(cur, table_name, columns, to_db)
+        con.commit()
+        nrows += len(to_db)
+        log_progress(table_name, nrows, start)
+    return nrows
+
+
+def _copy(
+        table_name,
+        con: psycopg2.extensions.connection,
+        stream: io.TextIOBase,
+        chunk_size=CHUNK_SIZE,
+        report=None,
+        binned=False,
+):
+    """Copy data from file into table with COPY FROM STDIN.
+
+    Each batch of `chunk_size` normalised rows is re-encoded as CSV, where
+    None becomes an unquoted empty field (NULL), and committed separately.
+    `report` and `binned` are as for `_insert`.
+    """
+    columns, chunks = _read(table_name, stream, chunk_size, report, binned)
+    if columns is None:
+        return 0
+
+    cur = con.cursor()
+    query = copy_query(table_name, columns)
+
+    nrows = 0
+    start = time.perf_counter()
+    for to_db in chunks:
+        buf = io.StringIO()
+        csv.writer(buf).writerows(to_db)
+        buf.seek(0)
+        cur.copy_expert(query, buf)
+        con.commit()
+        nrows += len(to_db)
+        log_progress(table_name, nrows, start)
+    return nrows
 
 
 if __name__ == "__main__":
@@ -166,7 +683,19 @@ if __name__ == "__main__":
     parser_insert = subparsers.add_parser('insert', help='insert data into database')
     parser_insert.add_argument('input_file', type=str, help='csv file')
     parser_insert.add_argument('table_name', type=str, help='table name')
+    parser_insert.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='number of rows inserted and committed per batch')
+    parser_insert.add_argument('--method', type=str, choices=['insert', 'copy'], default=LOAD_METHOD, help='load with INSERT (any database) or COPY FROM STDIN (postgres only)')
+    parser_insert.add_argument('--coerce', action='store_true', default=COERCE, help='cast and validate columns against the feature types, loading rejected values as NULL')
+    parser_insert.add_argument('--bin', action='store_true', default=BIN_FEATURES, help='bin raw values of features with edges in bins.json (implies --coerce)')
     parser_insert.set_defaults(func=insertargs)
+
+    # create the parser for the "validate" command
+    parser_validate = subparsers.add_parser('validate', help='report values rejected by type coercion without loading')
+    parser_validate.add_argument('input_file', type=str, help='csv file')
+    parser_validate.add_argument('table_name', type=str, help='table name')
+    parser_validate.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='number of rows validated per batch')
+    parser_validate.add_argument('--bin', action='store_true', default=BIN_FEATURES, help='bin raw values of features with edges in bins.json')
+    parser_validate.set_defaults(func=validateargs)
     
     args = parser.parse_args(sys.argv[1:])
     args.func(args)
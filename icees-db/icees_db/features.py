@@ -1,20 +1,76 @@
 from dataclasses import dataclass
+from functools import lru_cache
+import hashlib
 import os
-from typing import Any, List, Optional, Union, Type
+import pickle
+from typing import Any, Dict, Optional, Tuple, Union, Type
 import yaml
 
 from .config import get_config_path
 
+# the C loader is much faster on the 600 KB all_features.yaml
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-@dataclass
+
+@dataclass(frozen=True)
 class Feature:
-    name: str 
+    """Feature of a table.
+
+    `options` is a tuple of the allowed values, a range for integer features
+    with a minimum and maximum, or None. Equal option tuples are shared
+    between features.
+    """
+    __slots__ = ("name", "_type", "options")
+
+    name: str
     _type: Union[Type[int], Type[str], Type[float]]
-    options: Optional[List[Any]]
+    options: Optional[Union[Tuple[Any, ...], range]]
+
+
+_interned_options: Dict[Any, Any] = {}
+
+
+def intern_options(options):
+    """Return a shared instance of an option tuple or range."""
+    # keyed by repr so that e.g. (0, 1) and (False, True) are not merged
+    return _interned_options.setdefault(repr(options), options)
 
 
-with open(os.path.join(get_config_path(), 'all_features.yaml'), 'r') as f:
-    features_dict = yaml.load(f, Loader=yaml.SafeLoader)
+@lru_cache(maxsize=None)
+def get_features_dict():
+    """Load all_features.yaml on first use.
+
+    The parsed catalogue is snapshotted to all_features.cache.pickle in the
+    config directory together with the checksum of the YAML file, and the
+    snapshot is used for as long as the checksum matches.
+    """
+    config_path = get_config_path()
+    with open(os.path.join(config_path, 'all_features.yaml'), 'rb') as f:
+        content = f.read()
+    checksum = hashlib.sha256(content).hexdigest()
+    cache_path = os.path.join(config_path, 'all_features.cache.pickle')
+    try:
+        with open(cache_path, 'rb') as f:
+            snapshot = pickle.load(f)
+        if snapshot['checksum'] == checksum:
+            return snapshot['features']
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+        pass
+
+    features_dict = yaml.load(content, Loader=Loader)
+    try:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(
+                {'checksum': checksum, 'features': features_dict},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # read-only config directory, parse the YAML every time
+        pass
+    return features_dict
 
 
 def dict_to_Feature(table, key, value):
@@ -22,13 +78,13 @@ def dict_to_Feature(table, key, value):
     if value['type'] == 'integer':
         _type = int
         if 'minimum' in value and 'maximum' in value:
-            options = list(range(value['minimum'], value['maximum'] + 1))
+            options = intern_options(range(value['minimum'], value['maximum'] + 1))
         else:
             options = None
     elif value['type'] == 'string':
         _type = str
-        if 'enum' in value:
-            options = value['enum']
+        if value.get('enum') is not None:
+            options = intern_options(tuple(value['enum']))
         else:
             options = None
     elif value['type'] == 'number':
@@ -39,7 +95,28 @@ def dict_to_Feature(table, key, value):
     return Feature(key, _type, options)
 
 
-features = {
-    key0: [dict_to_Feature(key0, key1, value1) for key1, value1 in value0.items()]
-    for key0, value0 in features_dict.items()
-}
+@lru_cache(maxsize=None)
+def get_features():
+    """Feature catalogue: table -> list of Feature."""
+    return {
+        key0: [dict_to_Feature(key0, key1, value1) for key1, value1 in value0.items()]
+        for key0, value0 in get_features_dict().items()
+    }
+
+
+@lru_cache(maxsize=None)
+def get_feature_index():
+    """Feature catalogue indexed by name: table -> name -> Feature."""
+    return {
+        table: {feature.name: feature for feature in table_features}
+        for table, table_features in get_features().items()
+    }
+
+
+def __getattr__(name):
+    """Keep `features` and `features_dict` importable, loading them lazily."""
+    if name == 'features':
+        return get_features()
+    if name == 'features_dict':
+        return get_features_dict()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
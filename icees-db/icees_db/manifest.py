@@ -0,0 +1,149 @@
+"""Manifest of loaded shards for incremental loads.
+
+Each loaded shard is recorded in the `manifest` table with its size,
+checksum, row count and the years it contains. An incremental load compares
+the shards on disk to the manifest, and replaces the rows of every year
+touched by a new, changed or removed shard.
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from datetime import datetime
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from sqlalchemy import delete, insert, select
+
+from .dbutils import removeDotZero
+
+
+def checksum(file_path):
+    """sha256 of a file."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as stream:
+        for block in iter(lambda: stream.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def shard_years(file_path):
+    """Years present in a shard."""
+    if Path(file_path).suffix == ".parquet":
+        import pyarrow.parquet as pq  # requires pyarrow
+        column = pq.read_table(file_path, columns=["year"]).column("year")
+        return {year for year in column.unique().to_pylist() if year is not None}
+    years = set()
+    with open(file_path, "r", newline="") as stream:
+        reader = csv.reader(stream)
+        i = next(reader).index("year")
+        for row in reader:
+            if row[i] != "":
+                years.add(int(removeDotZero(row[i])))
+    return years
+
+
+def shard_info(table, file_path, years=True):
+    """Manifest entry of a shard, without its row count."""
+    return {
+        "path": file_path,
+        "table": table,
+        "size": os.path.getsize(file_path),
+        "checksum": checksum(file_path),
+        "years": shard_years(file_path) if years else None,
+    }
+
+
+def read_manifest(conn, metadata):
+    """Manifest entries by path."""
+    manifest = metadata.tables["manifest"]
+    return {
+        row.path: {
+            "path": row.path,
+            "table": row.table,
+            "size": row.size,
+            "checksum": row.checksum,
+            "rows": row.rows,
+            "years": set(json.loads(row.years)),
+        }
+        for row in conn.execute(select(manifest))
+    }
+
+
+def write_manifest(conn, metadata, infos, removed=()):
+    """Record loaded shards and forget removed ones."""
+    manifest = metadata.tables["manifest"]
+    paths = [info["path"] for info in infos] + list(removed)
+    if paths:
+        conn.execute(delete(manifest).where(manifest.c.path.in_(paths)))
+    if infos:
+        now = datetime.utcnow()
+        conn.execute(insert(manifest), [
+            {
+                "path": info["path"],
+                "table": info["table"],
+                "size": info["size"],
+                "checksum": info["checksum"],
+                "rows": info["rows"],
+                "years": json.dumps(sorted(info["years"])),
+                "load_time": now,
+            }
+            for info in infos
+        ])
+
+
+def plan(manifest, table_shards, workers=8):
+    """Work out what an incremental load has to do.
+
+    Returns the shards to load as (table, file path, partial manifest entry),
+    the affected years of each table, and the paths of removed shards.
+    Unchanged shards are reloaded too when they hold rows of an affected
+    year, since all rows of that year are replaced; their other years are
+    then affected as well.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        infos = list(executor.map(
+            lambda shard: shard_info(shard[0], shard[1], years=False),
+            table_shards,
+        ))
+
+    affected = defaultdict(set)
+    changed = []
+    unchanged = []
+    for info in infos:
+        old = manifest.get(info["path"])
+        if old is not None and old["checksum"] == info["checksum"]:
+            info["years"] = old["years"]
+            unchanged.append(info)
+        else:
+            info["years"] = shard_years(info["path"])
+            affected[info["table"]] |= info["years"]
+            if old is not None:
+                affected[old["table"]] |= old["years"]
+            changed.append(info)
+
+    current = {info["path"] for info in infos}
+    removed = [path for path in manifest if path not in current]
+    for path in removed:
+        affected[manifest[path]["table"]] |= manifest[path]["years"]
+
+    # an unchanged shard is reloaded whole, so all of its years are
+    # replaced too, which can pull in further shards
+    reloaded = []
+    pending = unchanged
+    while True:
+        overlapping = [info for info in pending if info["years"] & affected[info["table"]]]
+        if not overlapping:
+            break
+        pending = [info for info in pending if not info["years"] & affected[info["table"]]]
+        for info in overlapping:
+            affected[info["table"]] |= info["years"]
+        reloaded += overlapping
+
+    to_load = changed + reloaded
+    return (
+        [(info["table"], info["path"], info) for info in to_load],
+        {table: years for table, years in affected.items() if years},
+        removed,
+    )
@@ -2,16 +2,21 @@ import enum
 import logging
 
 from sqlalchemy import (
-    Table, Column, Float, Integer, String, MetaData, Sequence,
+    Table, Column, Float, Integer, BigInteger, String, MetaData, Sequence,
     Index, DateTime, Text, LargeBinary, Enum,
 )
 
-from .features import features
+from .features import get_features
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def generate_metadata(table_columns):
+def generate_metadata(table_columns, partition_by_year=False):
+  """Generate the schema.
+
+  With `partition_by_year`, the feature tables are partitioned by year (see
+  `icees_db.partition`).
+  """
 
   metadata = MetaData()
 
@@ -40,14 +45,19 @@ def generate_metadata(table_columns):
           Column("year", Integer),
       ] + [
           Column(feature.name, sql_type(feature._type))
-          for feature in features[table]
+          for feature in get_features()[table]
           if feature.name in columns
       ]
       for table, columns in table_columns.items()
   }
 
+  partition_options = {
+      "info": {"partition_by": "year"},
+      "postgresql_partition_by": "LIST (year)",
+  } if partition_by_year else {}
+
   tables = {
-      table : Table(table, metadata, *tab_cols)
+      table : Table(table, metadata, *tab_cols, **partition_options)
       for table, tab_cols in table_cols.items()
   }
 
@@ -64,40 +74,58 @@ def generate_metadata(table_columns):
       Column("table", String),
       Column("year", Integer),
       Column("size", Integer),
-      Column("features", String)
+      Column("features", String),
+      Column("digest", LargeBinary),
+      Column("members", LargeBinary)
   ]
 
   cohort = Table("cohort", metadata, *cohort_cols)
 
+  Index("cohort_digest_index", cohort.c.digest, unique=True)
+
   cohort_id_seq = Sequence('cohort_id_seq', metadata=metadata)
 
-  return metadata
+  association_cols = [
+      Column("digest", LargeBinary),
+      Column("table", String),
+      Column("cohort_features", String),
+      Column("cohort_year", Integer),
+      Column("feature_a", String),
+      Column("feature_b", String),
+      Column("association", Text),
+      Column("access_time", DateTime)
+  ]
+
+  cache = Table("cache", metadata, *association_cols)
+
+  Index("cache_index", cache.c.digest)
+  Index("cache_access_time_index", cache.c.access_time)
+
+  count_cols = [
+      Column("digest", LargeBinary),
+      Column("table", String),
+      Column("cohort_features", String),
+      Column("cohort_year", Integer),
+      Column("feature_a", String),
+      Column("count", Text),
+      Column("access_time", DateTime)
+  ]
+
+  cache_count = Table("cache_count", metadata, *count_cols)
 
-  # association_cols = [
-  #     Column("digest", LargeBinary),
-  #     Column("table", String),
-  #     Column("cohort_features", String),
-  #     Column("cohort_year", Integer),
-  #     Column("feature_a", String),
-  #     Column("feature_b", String),
-  #     Column("association", Text),
-  #     Column("access_time", DateTime)
-  # ]
-
-  # cache = Table("cache", metadata, *association_cols)
-
-  # Index("cache_index", cache.c.digest)
-
-  # count_cols = [
-  #     Column("digest", LargeBinary),
-  #     Column("table", String),
-  #     Column("cohort_features", String),
-  #     Column("cohort_year", Integer),
-  #     Column("feature_a", String),
-  #     Column("count", Text),
-  #     Column("access_time", DateTime)
-  # ]
-
-  # cache_count = Table("cache_count", metadata, *count_cols)
-
-  # Index("cache_count_index", cache_count.c.digest)
+  Index("cache_count_index", cache_count.c.digest)
+  Index("cache_count_access_time_index", cache_count.c.access_time)
+
+  manifest_cols = [
+      Column("path", String, primary_key=True),
+      Column("table", String),
+      Column("size", BigInteger),
+      Column("checksum", String),
+      Column("rows", Integer),
+      Column("years", String),
+      Column("load_time", DateTime)
+  ]
+
+  manifest = Table("manifest", metadata, *manifest_cols)
+
+  return metadata
@@ -0,0 +1,151 @@
+"""Per-year partitions of the feature tables.
+
+With PARTITION_BY_YEAR=1 every feature table is split by year, and each
+year is stored in its own partition `<table>_<year>`:
+
+- on postgres, the table is declared `PARTITION BY LIST (year)` and every
+  year is a partition of it. Rows inserted into the table are routed by
+  postgres, queries on one year are pruned to its partition, and indexes
+  created on the table are created on every partition.
+- on SQLite, every year is a table with the feature table's columns and its
+  own indexes, and the feature table is a view of their union, so queries
+  are unchanged. The loader routes rows to the year tables.
+
+A year is dropped or rebuilt by dropping its partition instead of deleting
+its rows.
+"""
+import logging
+import os
+import re
+
+from sqlalchemy import Column, MetaData, Table, inspect, text
+
+logger = logging.getLogger(__name__)
+
+PARTITION_BY_YEAR = os.environ.get("PARTITION_BY_YEAR", "0") == "1"
+
+
+def partition_name(table_name, year):
+    return f"{table_name}_{year}"
+
+
+def is_partitioned(table):
+    """Whether a table of `generate_metadata` is partitioned by year."""
+    return table.info.get("partition_by") == "year"
+
+
+def partition_table(table, year, metadata=None):
+    """Table object of the SQLite partition of `table` for `year`."""
+    return Table(
+        partition_name(table.name, year),
+        metadata if metadata is not None else MetaData(),
+        *(Column(column.name, column.type) for column in table.c),
+    )
+
+
+def partitions(conn, table_name):
+    """Partitions of a table in the database: {year: partition name}."""
+    if conn.dialect.name == "postgresql":
+        names = conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :table"
+        ), {"table": table_name}).scalars().all()
+    else:
+        names = inspect(conn).get_table_names()
+    pattern = re.compile(re.escape(table_name) + r"_(\d+)")
+    return {
+        int(match.group(1)): name
+        for name in names
+        if (match := pattern.fullmatch(name))
+    }
+
+
+def replace_view(conn, table):
+    """(Re)create the SQLite view of the union of a table's partitions.
+
+    Each partition's year is selected as a constant, so SQLite skips the
+    partitions of other years when a query's `year = ...` is pushed down.
+    """
+    def columns(year):
+        return ", ".join(
+            f'{int(year)} AS "year"' if column.name == "year" else f'"{column.name}"'
+            for column in table.c
+        )
+    selects = [
+        f'SELECT {columns(year)} FROM "{name}"'
+        for year, name in sorted(partitions(conn, table.name).items())
+    ]
+    if not selects:
+        nulls = ", ".join(f'NULL AS "{column.name}"' for column in table.c)
+        selects = [f"SELECT {nulls} WHERE 0"]
+    conn.execute(text(f'DROP VIEW IF EXISTS "{table.name}"'))
+    conn.execute(text(f'CREATE VIEW "{table.name}" AS ' + " UNION ALL ".join(selects)))
+
+
+def create_partitions(conn, metadata, table_years):
+    """Create the missing partitions of the given years.
+
+    `table_years` maps table to years; tables that are not partitioned are
+    skipped.
+    """
+    for table_name, years in table_years.items():
+        table = metadata.tables[table_name]
+        if not is_partitioned(table):
+            continue
+        existing = partitions(conn, table_name)
+        todo = sorted(set(years) - set(existing))
+        for year in todo:
+            logger.info(f"creating partition {partition_name(table_name, year)}")
+            if conn.dialect.name == "postgresql":
+                conn.execute(text(
+                    f'CREATE TABLE "{partition_name(table_name, year)}" '
+                    f'PARTITION OF "{table_name}" FOR VALUES IN ({int(year)})'
+                ))
+            else:
+                partition_table(table, year).create(conn)
+        if todo and conn.dialect.name == "sqlite":
+            replace_view(conn, table)
+
+
+def drop_partitions(conn, metadata, table_years):
+    """Drop the partitions of the given years, with their rows and indexes."""
+    for table_name, years in table_years.items():
+        table = metadata.tables[table_name]
+        if not is_partitioned(table):
+            continue
+        existing = partitions(conn, table_name)
+        todo = sorted(set(years) & set(existing))
+        for year in todo:
+            logger.info(f"dropping partition {existing[year]}")
+            conn.execute(text(f'DROP TABLE "{existing[year]}"'))
+        if todo and conn.dialect.name == "sqlite":
+            replace_view(conn, table)
+
+
+def storage_tables(conn, table):
+    """Names of the database tables that hold the rows of `table`.
+
+    The partitions of a partitioned SQLite table, otherwise the table itself
+    if it exists (postgres forwards DDL on a partitioned table to its
+    partitions).
+    """
+    if is_partitioned(table) and conn.dialect.name == "sqlite":
+        return [name for _, name in sorted(partitions(conn, table.name).items())]
+    return [table.name] if inspect(conn).has_table(table.name) else []
+
+
+def reflect(conn, metadata, **kw):
+    """Reflect the database into `metadata` without the partitions.
+
+    Views are included, so a partitioned SQLite table is reflected from its
+    view.
+    """
+    metadata.reflect(conn, views=True, **kw)
+    names = set(metadata.tables)
+    for name in list(names):
+        match = re.fullmatch(r"(.+)_\d+", name)
+        if match and match.group(1) in names:
+            metadata.remove(metadata.tables[name])
+    return metadata
@@ -0,0 +1,69 @@
+"""Schema discovery from shard headers."""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import logging
+from typing import Dict, List
+
+from .dbutils import read_headers
+from .features import get_feature_index
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SchemaReport:
+    """Result of `discover_schema`.
+
+    `table_columns` is the union of the shard headers of each table, in
+    order of first appearance, ready for `generate_metadata`. `missing` maps
+    each shard to the columns of its table it does not have (loaded as NULL),
+    and `unknown` maps each shard to the columns that are not in
+    all_features.yaml (which have no database column to load into).
+    """
+    table_columns: Dict[str, List[str]]
+    missing: Dict[str, List[str]] = field(default_factory=dict)
+    unknown: Dict[str, List[str]] = field(default_factory=dict)
+
+
+def discover_schema(table_shards, workers=8, strict=True):
+    """Read the header line of every (table, file path) shard in parallel.
+
+    With `strict`, raises ValueError if any shard has columns that are not
+    in all_features.yaml, instead of failing part way through the load.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        headers = list(executor.map(
+            lambda shard: read_headers(shard[1], shard[0]),
+            table_shards,
+        ))
+
+    table_columns = {}
+    for (table, _), header in zip(table_shards, headers):
+        columns = table_columns.setdefault(table, [])
+        seen = set(columns)
+        columns.extend(col for col in header if col not in seen)
+
+    report = SchemaReport(table_columns)
+    feature_index = get_feature_index()
+    for (table, file_path), header in zip(table_shards, headers):
+        id_col = table[0].upper() + table[1:] + "Id"
+        present = set(header)
+        missing = [col for col in table_columns[table] if col not in present]
+        unknown = [
+            col for col in header
+            if col not in (id_col, "year") and col not in feature_index[table]
+        ]
+        if missing:
+            report.missing[file_path] = missing
+            logger.info(f"{file_path}: {len(missing)} columns missing: {', '.join(missing[:10])}")
+        if unknown:
+            report.unknown[file_path] = unknown
+            logger.warning(f"{file_path}: columns not in all_features.yaml: {', '.join(unknown)}")
+    if strict and report.unknown:
+        raise ValueError(
+            "columns not in all_features.yaml: " + "; ".join(
+                f"{file_path}: {', '.join(columns)}"
+                for file_path, columns in report.unknown.items()
+            )
+        )
+    return report
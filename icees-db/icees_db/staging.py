@@ -0,0 +1,229 @@
+"""Columnar Parquet staging of the CSV shards.
+
+Converting each DATA_PATH/<table>/ shard to typed Parquet once (with the
+column types from `icees_db.features`) lets later rebuilds load Arrow record
+batches directly instead of re-parsing the CSVs. Requires pyarrow.
+"""
+import argparse
+from collections import Counter, defaultdict
+import csv
+import io
+import json
+import logging
+import os
+from pathlib import Path
+import sys
+import time
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from .binning import get_binner
+from .dbutils import (
+    BIN_FEATURES, CHUNK_SIZE, COERCE, coerce_columns, copy_query, insert_rows,
+    log_progress, log_report,
+)
+from .features import get_feature_index, get_features_dict
+
+logger = logging.getLogger(__name__)
+
+arrow_types = {
+    int: pa.int64(),
+    float: pa.float64(),
+    str: pa.string(),
+}
+
+
+def arrow_schema(table_name, header):
+    """Arrow schema of a CSV shard, with "index" renamed to the table id."""
+    index = table_name[0].upper() + table_name[1:] + "Id"
+    table_features = get_feature_index()[table_name]
+    fields = []
+    for col in header:
+        if col == "index":
+            fields.append(pa.field(index, pa.int64()))
+        elif col == "year":
+            fields.append(pa.field(col, pa.int64()))
+        else:
+            feature = table_features.get(col)
+            fields.append(pa.field(col, arrow_types[feature._type if feature else str]))
+    return pa.schema(fields)
+
+
+def _normalise(array, arrow_type):
+    """Vectorised removeDotZero and emptyStringToNone, then cast."""
+    array = pc.replace_substring_regex(array, pattern=r"\.0$", replacement="")
+    array = pc.if_else(pc.equal(array, ""), pa.scalar(None, pa.string()), array)
+    return array.cast(arrow_type)
+
+
+def convert_shard(csv_path, parquet_path, table_name, binned=BIN_FEATURES, coerce=COERCE):
+    """Convert one CSV shard to Parquet, returning the number of rows.
+
+    With `coerce` (implied by `binned`), columns are cast and validated with
+    `coerce_columns` as `dbutils.insert` does for CSV files, and rejected
+    values are summarised in the log and staged as NULL; the Parquet
+    metadata records that the shard is coerced. With `binned`, raw values of
+    binned features are binned first. The years of the shard and the digest
+    of their edges are then recorded in the Parquet metadata, so `is_staged`
+    notices when the edges change.
+    """
+    with open(csv_path, "r") as stream:
+        header = next(csv.reader(stream))
+    schema = arrow_schema(table_name, header)
+    reader = pa_csv.open_csv(
+        csv_path,
+        convert_options=pa_csv.ConvertOptions(
+            column_types={col: pa.string() for col in header},
+            strings_can_be_null=False,
+        ),
+    )
+    tmp_path = str(parquet_path) + ".tmp"
+    binner = get_binner() if binned else None
+    coerce = coerce or binned
+    report = defaultdict(Counter)
+    years = set()
+    nrows = 0
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for batch in reader:
+            if coerce:
+                df = batch.to_pandas()
+                df.columns = schema.names
+                if binner is not None:
+                    df = binner.bin_frame(df, table_name, report)
+                batch = pa.RecordBatch.from_pandas(
+                    coerce_columns(df, table_name, report),
+                    schema=schema,
+                    preserve_index=False,
+                )
+            else:
+                arrays = []
+                for i, field in enumerate(schema):
+                    try:
+                        arrays.append(_normalise(batch.column(i), field.type))
+                    except pa.ArrowInvalid as err:
+                        raise ValueError(f"{csv_path}: column {header[i]}: {err}") from err
+                batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+            writer.write_batch(batch)
+            if binner is not None:
+                years.update(pc.unique(batch.column("year")).drop_null().to_pylist())
+            nrows += batch.num_rows
+        if coerce:
+            writer.add_key_value_metadata({"icees_coerced": "1"})
+        if binner is not None:
+            writer.add_key_value_metadata({
+                "icees_bin_years": json.dumps(sorted(years)),
+                "icees_bin_digest": binner.digest(table_name, years),
+            })
+    os.replace(tmp_path, parquet_path)
+    log_report(csv_path, report)
+    return nrows
+
+
+def staged_path(staging_dir, table_name, csv_path):
+    """Path of the Parquet file of a CSV shard."""
+    return Path(staging_dir) / table_name / (Path(csv_path).stem + ".parquet")
+
+
+def is_coerced(parquet_path):
+    """Whether a Parquet file was staged with `coerce`."""
+    metadata = pq.read_metadata(parquet_path).metadata or {}
+    return metadata.get(b"icees_coerced") == b"1"
+
+
+def is_staged(table_name, parquet_path, csv_path, binned=BIN_FEATURES, coerce=COERCE):
+    """Whether a Parquet file exists and is newer than its CSV shard.
+
+    With `coerce` or `binned`, it must also have been coerced, and with
+    `binned`, binned with the current edges of its years.
+    """
+    parquet_path = Path(parquet_path)
+    if not parquet_path.exists() or parquet_path.stat().st_mtime < os.stat(csv_path).st_mtime:
+        return False
+    if (coerce or binned) and not is_coerced(parquet_path):
+        return False
+    if not binned:
+        return True
+    metadata = pq.read_metadata(parquet_path).metadata or {}
+    if b"icees_bin_digest" not in metadata:
+        return False
+    years = set(json.loads(metadata[b"icees_bin_years"]))
+    return metadata[b"icees_bin_digest"].decode() == get_binner().digest(table_name, years)
+
+
+def stage(table_shards, staging_dir):
+    """Convert (table, csv path) shards to Parquet under `staging_dir`/<table>/.
+
+    Shards whose Parquet file is up to date (see `is_staged`) are not
+    converted again. Returns the (table, parquet path) shards.
+    """
+    staged = []
+    for table_name, csv_path in table_shards:
+        parquet_path = staged_path(staging_dir, table_name, csv_path)
+        parquet_path.parent.mkdir(parents=True, exist_ok=True)
+        if not is_staged(table_name, parquet_path, csv_path):
+            start = time.perf_counter()
+            nrows = convert_shard(csv_path, parquet_path, table_name)
+            logger.info(
+                f"staged {csv_path} as {parquet_path}: "
+                f"{nrows} rows in {time.perf_counter() - start:.1f}s"
+            )
+        staged.append((table_name, str(parquet_path)))
+    return staged
+
+
+def read_parquet_headers(file_path):
+    """Column names of a staged shard."""
+    return pq.read_schema(file_path).names
+
+
+def insert_batches(table_name, con, stream: io.RawIOBase, chunk_size=CHUNK_SIZE):
+    """Insert a staged shard with executemany, one record batch at a time."""
+    parquet_file = pq.ParquetFile(stream)
+    columns = parquet_file.schema_arrow.names
+    cur = con.cursor()
+    nrows = 0
+    start = time.perf_counter()
+    for batch in parquet_file.iter_batches(batch_size=chunk_size):
+        to_db = list(zip(*(column.to_pylist() for column in batch.columns)))
+        insert_rows(cur, table_name, columns, to_db)
+        con.commit()
+        nrows += batch.num_rows
+        log_progress(table_name, nrows, start)
+    return nrows
+
+
+def copy_batches(table_name, con, stream: io.RawIOBase, chunk_size=CHUNK_SIZE):
+    """Copy a staged shard with COPY FROM STDIN, one record batch at a time."""
+    parquet_file = pq.ParquetFile(stream)
+    columns = parquet_file.schema_arrow.names
+    cur = con.cursor()
+    query = copy_query(table_name, columns)
+    nrows = 0
+    start = time.perf_counter()
+    for batch in parquet_file.iter_batches(batch_size=chunk_size):
+        buf = io.BytesIO()
+        pa_csv.write_csv(batch, buf, pa_csv.WriteOptions(include_header=False))
+        buf.seek(0)
+        cur.copy_expert(query, buf)
+        con.commit()
+        nrows += batch.num_rows
+        log_progress(table_name, nrows, start)
+    return nrows
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='ICEES DB staging')
+    parser.add_argument('data_path', type=str, help='directory of <table>/ CSV shard directories')
+    parser.add_argument('staging_path', type=str, help='output directory for Parquet shards')
+    args = parser.parse_args(sys.argv[1:])
+    table_shards = [
+        (t, os.path.join(args.data_path, t, f))
+        for t in sorted(os.listdir(args.data_path))
+        if t in get_features_dict() and os.path.isdir(os.path.join(args.data_path, t))
+        for f in sorted(os.listdir(os.path.join(args.data_path, t)))
+    ]
+    stage(table_shards, args.staging_path)
@@ -0,0 +1,142 @@
+"""Statistics of stacked contingency tables.
+
+Every function takes an (n, rows, columns) array of counts, or (n, 2, 2)
+for the 2x2 tests, and scores all n tables at once.
+"""
+import numpy as np
+from scipy.special import chdtrc, ndtri
+from scipy.stats import hypergeom
+
+
+def chi_square(tables):
+    """Chi-square test of independence.
+
+    Empty rows and columns are ignored. Returns the statistics, degrees of
+    freedom and p-values; tables with no degree of freedom get NaN.
+    """
+    tables = np.asarray(tables, dtype=np.float64)
+    row_totals = tables.sum(axis=2, keepdims=True)
+    column_totals = tables.sum(axis=1, keepdims=True)
+    total = tables.sum(axis=(1, 2), keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = row_totals * column_totals / total
+        cells = np.where(expected > 0, (tables - expected) ** 2 / expected, 0)
+    statistic = cells.sum(axis=(1, 2))
+    # clamped, so an empty table gets no degree of freedom rather than 1
+    dof = (
+        np.maximum(np.count_nonzero(row_totals[:, :, 0], axis=1) - 1, 0)
+        * np.maximum(np.count_nonzero(column_totals[:, 0, :], axis=1) - 1, 0)
+    )
+    p_value = np.where(dof > 0, chdtrc(np.maximum(dof, 1), statistic), np.nan)
+    statistic = np.where(dof > 0, statistic, np.nan)
+    return statistic, dof, p_value
+
+
+def _cells(tables):
+    tables = np.asarray(tables)
+    if tables.shape[1:] != (2, 2):
+        raise ValueError(f"Expected (n, 2, 2) tables, got {tables.shape}")
+    return tables[:, 0, 0], tables[:, 0, 1], tables[:, 1, 0], tables[:, 1, 1]
+
+
+def odds_ratio(tables, alpha=0.05):
+    """Odds ratios of 2x2 tables with Woolf (log) confidence intervals.
+
+    Returns the odds ratios and the lower and upper `1 - alpha` confidence
+    limits. A zero cell gives an odds ratio of 0 or inf (NaN if both
+    diagonals have one) and the interval (0, inf).
+    """
+    a, b, c, d = (cell.astype(np.float64) for cell in _cells(tables))
+    z = ndtri(1 - alpha / 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = (a * d) / (b * c)
+        se = np.sqrt(1 / a + 1 / b + 1 / c + 1 / d)
+        log_ratio = np.log(ratio)
+        lower = np.exp(log_ratio - z * se)
+        upper = np.exp(log_ratio + z * se)
+    zero = (a == 0) | (b == 0) | (c == 0) | (d == 0)
+    lower = np.where(zero, 0.0, lower)
+    upper = np.where(zero, np.inf, upper)
+    return ratio, lower, upper
+
+
+def _search(logpmf, lo, hi, threshold, below_upward):
+    """Vectorised binary search of a monotone stretch of a unimodal pmf.
+
+    With `below_upward`, pmf is decreasing on [lo, hi] and the smallest x
+    with logpmf(x) <= threshold is returned; otherwise pmf is increasing and
+    the largest such x is returned. The end where the condition holds must
+    satisfy it.
+    """
+    lo, hi = lo.copy(), hi.copy()
+    while True:
+        active = hi - lo > 1
+        if not active.any():
+            return hi if below_upward else lo
+        mid = (lo + hi) // 2
+        below = logpmf(mid) <= threshold
+        if below_upward:
+            hi = np.where(active & below, mid, hi)
+            lo = np.where(active & ~below, mid, lo)
+        else:
+            lo = np.where(active & below, mid, lo)
+            hi = np.where(active & ~below, mid, hi)
+
+
+def fisher_exact(tables):
+    """Two-sided Fisher exact test of 2x2 tables.
+
+    The p-value sums the hypergeometric probabilities of every table with
+    the same margins that is at most as likely as the observed one, as in
+    scipy: the tail of the observed value plus the opposite tail from the
+    first value as unlikely, found by binary search on the unimodal pmf.
+    Every step is vectorised over the tables.
+    """
+    a, b, c, d = (cell.astype(np.int64) for cell in _cells(tables))
+    row1 = a + b
+    column1 = a + c
+    total = a + b + c + d
+    low = np.maximum(0, row1 + column1 - total)
+    high = np.minimum(row1, column1)
+    distribution = hypergeom(total, row1, column1)
+
+    def logpmf(k):
+        return distribution.logpmf(k)
+
+    mode = np.clip((column1 + 1) * (row1 + 1) // (total + 2), low, high)
+    observed = logpmf(a)
+    # relative tolerance as in scipy, for ties lost to rounding
+    threshold = observed + np.log1p(1e-7)
+    p_value = np.ones(len(a))
+    with np.errstate(invalid="ignore"):
+        degenerate = (high == low) | (logpmf(mode) <= threshold)
+
+    # observed below the mode: its lower tail and the upper tail from the
+    # smallest value above the mode that is as unlikely
+    lower = ~degenerate & (a < mode)
+    upper_tail = np.zeros(len(a))
+    has_tail = lower & (logpmf(high) <= threshold)
+    start = _search(logpmf, mode, high, threshold, True)
+    upper_tail[has_tail] = distribution.sf(start - 1)[has_tail]
+    p_value[lower] = distribution.cdf(a)[lower] + upper_tail[lower]
+
+    # observed above the mode: the mirror image
+    upper = ~degenerate & (a > mode)
+    lower_tail = np.zeros(len(a))
+    has_tail = upper & (logpmf(low) <= threshold)
+    end = _search(logpmf, low, mode, threshold, False)
+    lower_tail[has_tail] = distribution.cdf(end)[has_tail]
+    p_value[upper] = distribution.sf(a - 1)[upper] + lower_tail[upper]
+    return np.minimum(p_value, 1)
+
+
+def bonferroni(p_values, ntests=None):
+    """Bonferroni-corrected p-values, capped at 1.
+
+    By default the number of tests is the number of finite p-values, so
+    untestable tables (NaN) are not counted.
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    if ntests is None:
+        ntests = np.count_nonzero(np.isfinite(p_values))
+    return np.minimum(p_values * ntests, 1)